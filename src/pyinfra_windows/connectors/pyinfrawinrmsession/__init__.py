@@ -1,26 +1,336 @@
 import base64
+import gzip
+import re
+from collections import Counter
+from time import perf_counter
 
 import winrm
 
+# WinRS runs commands through cmd.exe, which limits a command line to 8191 characters
+MAX_COMMAND_LENGTH = 8191
+
+# Inflates and runs a gzipped script, used when the encoded script is too long
+GZIP_BOOTSTRAP = (
+    "$s=New-Object IO.Compression.GZipStream("
+    "(New-Object IO.MemoryStream(,[Convert]::FromBase64String('{0}'))),"
+    "[IO.Compression.CompressionMode]::Decompress);"
+    "Invoke-Expression (New-Object IO.StreamReader($s)).ReadToEnd()"
+)
+
+# Inflates and runs a gzipped script sent base64 encoded on standard input, used
+# when even the gzipped script is too long for the command line
+STDIN_BOOTSTRAP = (
+    "$s=New-Object IO.Compression.GZipStream("
+    "(New-Object IO.MemoryStream(,[Convert]::FromBase64String(-join $input))),"
+    "[IO.Compression.CompressionMode]::Decompress);"
+    "Invoke-Expression (New-Object IO.StreamReader($s)).ReadToEnd()"
+)
+
+# Characters of the script sent per Send request by the stdin bootstrap
+STDIN_CHUNK_SIZE = 64 * 1024
+
+
+# The wrappers below run more commands after the script, which would replace its
+# exit status: it is kept after the script (for a failed last statement, the exit
+# code of the last program or 1) and exited with after the wrappers
+SCRIPT_STATUS_CAPTURE = (
+    "$global:__pyinfra_ok = $?; $global:__pyinfra_exit_code = $LASTEXITCODE"
+)
+EXIT_WITH_SCRIPT_STATUS = (
+    "if (-not $__pyinfra_ok) { "
+    "exit $(if ($__pyinfra_exit_code) { $__pyinfra_exit_code } else { 1 }) }"
+)
+
+
+# Times a script on the target and writes the elapsed ticks (100ns) after its
+# output, even when the script fails or exits early
+REMOTE_TIMING_SENTINEL = "__PYINFRA_REMOTE_TICKS__"
+REMOTE_TIMING_WRAPPER = (
+    "$__pyinfra_sw = [Diagnostics.Stopwatch]::StartNew()\n"
+    "try {{\n{0}\n}} finally {{\n"
+    "$__pyinfra_sw.Stop(); "
+    "[Console]::Out.WriteLine('" + REMOTE_TIMING_SENTINEL + " ' + "
+    "$__pyinfra_sw.Elapsed.Ticks)\n}}"
+)
+REMOTE_TIMING_REGEX = re.compile(REMOTE_TIMING_SENTINEL + r" ([0-9]+)(?:\r\n)?")
+
+
+# Runs a script and writes its output gzipped & base64 encoded on one line, for
+# large outputs over slow links. The output is formatted by Out-String, as it
+# would be for the console.
+COMPRESSED_OUTPUT_MARKER = "__PYINFRA_GZIP__"
+COMPRESS_OUTPUT_WRAPPER = (
+    "$__pyinfra_output = & {{\n{0}\n}} | Out-String\n"
+    "$__pyinfra_buffer = New-Object IO.MemoryStream\n"
+    "$__pyinfra_gzip = New-Object IO.Compression.GZipStream("
+    "$__pyinfra_buffer, [IO.Compression.CompressionMode]::Compress)\n"
+    "$__pyinfra_bytes = [Text.Encoding]::UTF8.GetBytes($__pyinfra_output)\n"
+    "$__pyinfra_gzip.Write($__pyinfra_bytes, 0, $__pyinfra_bytes.Length)\n"
+    "$__pyinfra_gzip.Close()\n"
+    "[Console]::Out.WriteLine('" + COMPRESSED_OUTPUT_MARKER + " ' + "
+    "[Convert]::ToBase64String($__pyinfra_buffer.ToArray()))"
+)
+COMPRESSED_OUTPUT_REGEX = re.compile(
+    COMPRESSED_OUTPUT_MARKER + r" ([A-Za-z0-9+/=]*)(?:\r\n)?",
+)
+
+
+def _decompress_output(std_out):
+    """
+    Replace the compressed output line with the original output, leaving any
+    other output (eg from ``[Console]::Out``) in place.
+    """
+
+    text = std_out.decode("utf-8")
+    match = COMPRESSED_OUTPUT_REGEX.search(text)
+    if not match:
+        return std_out
+
+    output = gzip.decompress(base64.b64decode(match.group(1))).decode("utf-8")
+    return (text[: match.start()] + output + text[match.end() :]).encode("utf-8")
+
+
+# Runs a script and only writes its output if the SHA256 of it differs from the
+# given hash (that of the output cached locally); either way the hash is written
+# first, on a marker line
+OUTPUT_HASH_MARKER = "__PYINFRA_OUTPUT_HASH__"
+OUTPUT_UNCHANGED_MARKER = "__PYINFRA_OUTPUT_UNCHANGED__"
+CONDITIONAL_OUTPUT_WRAPPER = (
+    "$__pyinfra_output = & {{\n{0}\n}} | Out-String\n"
+    "$__pyinfra_hash = [BitConverter]::ToString("
+    "[Security.Cryptography.SHA256]::Create().ComputeHash("
+    "[Text.Encoding]::UTF8.GetBytes($__pyinfra_output))).Replace('-', '')\n"
+    "if ($__pyinfra_hash -eq '{1}') {{ "
+    "Write-Output ('" + OUTPUT_UNCHANGED_MARKER + " ' + $__pyinfra_hash) "
+    "}} else {{ "
+    'if ($__pyinfra_output.EndsWith("`r`n")) {{ '
+    "$__pyinfra_output = $__pyinfra_output.Substring(0, $__pyinfra_output.Length - 2) "
+    "}}; "
+    "Write-Output ('" + OUTPUT_HASH_MARKER + " ' + $__pyinfra_hash)\n"
+    "Write-Output $__pyinfra_output }}"
+)
+OUTPUT_HASH_REGEX = re.compile(
+    "^(" + OUTPUT_HASH_MARKER + "|" + OUTPUT_UNCHANGED_MARKER + r") ([0-9A-F]+)\r\n",
+    re.MULTILINE,
+)
+
+
+def _pop_output_hash(std_out):
+    """
+    Remove the output hash line from the output, returning the output, the hash
+    and whether the output is unchanged (in which case the output is empty).
+    """
+
+    text = std_out.decode("utf-8")
+    match = OUTPUT_HASH_REGEX.search(text)
+    if not match:
+        return std_out, None, False
+
+    text = text[: match.start()] + text[match.end() :]
+    unchanged = match.group(1) == OUTPUT_UNCHANGED_MARKER
+    return text.encode("utf-8"), match.group(2), unchanged
+
+
+def _pop_remote_timing(std_out):
+    """
+    Remove the remote timing line from the output, returning the output and the
+    remote execution time in seconds (``None`` if the script never finished).
+    """
+
+    text = std_out.decode("utf-8")
+    matches = list(REMOTE_TIMING_REGEX.finditer(text))
+    if not matches:
+        return std_out, None
+
+    match = matches[-1]
+    std_out = (text[: match.start()] + text[match.end() :]).encode("utf-8")
+    return std_out, int(match.group(1)) / 10_000_000
+
+
+def _encode_ps(script):
+    # must use utf16 little endian on windows
+    return base64.b64encode(script.encode("utf_16_le")).decode("ascii")
+
 
 class PyinfraWinrmSession(winrm.Session):
     """This is our subclassed Session that allows for env setting"""
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # SOAP requests & bytes on the wire, shells and PowerShell processes started
+        self.counters = Counter()
+        send_message = self.protocol.send_message
+
+        def counted_send_message(message):
+            response = send_message(message)
+            self.counters["soap_requests"] += 1
+            self.counters["bytes_sent"] += len(
+                message.encode("utf-8") if isinstance(message, str) else message
+            )
+            self.counters["bytes_received"] += len(response)
+            return response
+
+        self.protocol.send_message = counted_send_message
+
+        # (phase, seconds) for each timed step, drained by the connector
+        self.timings = []
+
+    def _timed(self, phase, func, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.timings.append((phase, perf_counter() - start))
+
     def run_cmd(self, command, args=(), env=None):
-        shell_id = self.protocol.open_shell(env_vars=env)
-        command_id = self.protocol.run_command(shell_id, command, args)
-        rs = winrm.Response(self.protocol.get_command_output(shell_id, command_id))
-        self.protocol.cleanup_command(shell_id, command_id)
-        self.protocol.close_shell(shell_id)
+        self.counters["shells_opened"] += 1
+        shell_id = self._timed("open_shell", self.protocol.open_shell, env_vars=env)
+        command_id = self._timed(
+            "run_command", self.protocol.run_command, shell_id, command, args
+        )
+        rs = winrm.Response(
+            self._timed(
+                "receive", self.protocol.get_command_output, shell_id, command_id
+            ),
+        )
+        self._timed(
+            "cleanup_command", self.protocol.cleanup_command, shell_id, command_id
+        )
+        self._timed("close_shell", self.protocol.close_shell, shell_id)
+        return rs
+
+    def run_ps_with_input(self, script, input_chunks, env=None):
+        """
+        Runs a PowerShell script in a single shell, sending each of ``input_chunks``
+        to its standard input in its own WinRM request.
+        """
+        self.counters["powershell_launches"] += 1
+        command, script_input = self._timed(
+            "encode_command", self._make_ps_command, script
+        )
+        if script_input is not None:
+            raise ValueError(
+                "PowerShell script too long to run with input: {0} characters".format(
+                    len(script),
+                ),
+            )
+        rs = self._run_cmd_with_input(command, input_chunks, env=env)
+        if len(rs.std_err):
+            rs.std_err = self._clean_error_msg(rs.std_err)
+        return rs
+
+    def _run_cmd_with_input(self, command, input_chunks, env=None):
+        self.counters["shells_opened"] += 1
+        shell_id = self._timed("open_shell", self.protocol.open_shell, env_vars=env)
+        command_id = self._timed(
+            "run_command", self.protocol.run_command, shell_id, command
+        )
+        for chunk in input_chunks:
+            self._timed(
+                "send_input",
+                self.protocol.send_command_input,
+                shell_id,
+                command_id,
+                chunk,
+            )
+        self._timed(
+            "send_input",
+            self.protocol.send_command_input,
+            shell_id,
+            command_id,
+            "",
+            end=True,
+        )
+        rs = winrm.Response(
+            self._timed(
+                "receive", self.protocol.get_command_output, shell_id, command_id
+            ),
+        )
+        self._timed(
+            "cleanup_command", self.protocol.cleanup_command, shell_id, command_id
+        )
+        self._timed("close_shell", self.protocol.close_shell, shell_id)
         return rs
 
-    def run_ps(self, script, env=None):
+    def _make_ps_command(self, script):
+        """
+        Returns the command running a script, and the chunks to send on its standard
+        input (``None`` unless the script is too long for the command line even
+        gzipped, in which case it is sent that way).
+        """
+        command = "powershell -encodedcommand {0}".format(_encode_ps(script))
+        if len(command) <= MAX_COMMAND_LENGTH:
+            return command, None
+
+        compressed = base64.b64encode(gzip.compress(script.encode("utf-8")))
+        command = "powershell -encodedcommand {0}".format(
+            _encode_ps(GZIP_BOOTSTRAP.format(compressed.decode("ascii"))),
+        )
+        if len(command) <= MAX_COMMAND_LENGTH:
+            return command, None
+
+        return "powershell -encodedcommand {0}".format(_encode_ps(STDIN_BOOTSTRAP)), [
+            compressed[i : i + STDIN_CHUNK_SIZE]
+            for i in range(0, len(compressed), STDIN_CHUNK_SIZE)
+        ]
+
+    def run_ps(
+        self,
+        script,
+        env=None,
+        remote_timing=False,
+        compress_output=False,
+        conditional_output=False,
+        known_output_hash=None,
+    ):
         """base64 encodes a Powershell script and executes the powershell
         encoded script command
+
+        Scripts too long for the command line are gzipped, and when still too
+        long sent gzipped on the standard input of a small bootstrap script.
+
+        With ``remote_timing`` the script is timed on the target and the time
+        is set as ``remote_seconds`` on the response. With ``compress_output``
+        the output is gzipped on the target and decompressed here. As the output
+        is collected with ``Out-String`` first, objects are formatted as text as
+        the console would, and a script calling ``exit`` loses its output. Both
+        keep the exit status of the script.
+
+        With ``conditional_output`` the SHA256 of the output is set as
+        ``output_hash`` on the response, and if it matches ``known_output_hash``
+        the output is left out and ``output_unchanged`` is set. Like the above,
+        the output is formatted with ``Out-String`` and the exit status is kept.
         """
-        # must use utf16 little endian on windows
-        encoded_ps = base64.b64encode(script.encode("utf_16_le")).decode("ascii")
-        rs = self.run_cmd("powershell -encodedcommand {0}".format(encoded_ps), env=env)
+        self.counters["powershell_launches"] += 1
+        keep_status = remote_timing or compress_output or conditional_output
+        if keep_status:
+            script = "{0}\n{1}".format(script, SCRIPT_STATUS_CAPTURE)
+        if conditional_output:
+            script = CONDITIONAL_OUTPUT_WRAPPER.format(script, known_output_hash or "")
+        if compress_output:
+            script = COMPRESS_OUTPUT_WRAPPER.format(script)
+        if remote_timing:
+            script = REMOTE_TIMING_WRAPPER.format(script)
+        if keep_status:
+            script = "{0}\n{1}".format(script, EXIT_WITH_SCRIPT_STATUS)
+        command, script_input = self._timed(
+            "encode_command", self._make_ps_command, script
+        )
+        if script_input is None:
+            rs = self.run_cmd(command, env=env)
+        else:
+            rs = self._run_cmd_with_input(command, script_input, env=env)
+        if remote_timing:
+            rs.std_out, rs.remote_seconds = _pop_remote_timing(rs.std_out)
+        if compress_output:
+            rs.std_out = self._timed(
+                "decompress_output", _decompress_output, rs.std_out
+            )
+        if conditional_output:
+            rs.std_out, rs.output_hash, rs.output_unchanged = _pop_output_hash(
+                rs.std_out,
+            )
         if len(rs.std_err):
             # if there was an error message, clean it it up and make it human
             # readable
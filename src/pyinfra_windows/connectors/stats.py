@@ -0,0 +1,373 @@
+"""
+Accounting of what the ``@winrm`` connector costs on the wire, per host and per
+operation/fact, plus latency histograms for each step of running a command.
+Enabled by setting the ``winrm_stats_report`` host data to the path of a report,
+which is written (along with a summary table) when pyinfra exits. The report is
+JSON unless the filename ends with ``.prom``, in which case it is written in the
+Prometheus text format.
+"""
+
+from __future__ import annotations
+
+import atexit
+import json
+from bisect import bisect_left
+from collections import Counter
+
+import click
+
+from .util import get_current_fact_name
+
+COUNTERS = (
+    "commands",
+    "soap_requests",
+    "shells_opened",
+    "powershell_launches",
+    "bytes_sent",
+    "bytes_received",
+    "upload_bytes",
+    "upload_seconds",
+    "wall_seconds",
+    "remote_seconds",
+    "unchanged_outputs",
+)
+
+ROW_FORMAT = "{0:<40} {1:>8} {2:>8} {3:>7} {4:>7} {5:>10} {6:>10} {7:>10} {8:>8} {9:>8}"
+
+# The steps of running a command, in order
+PHASES = (
+    "encode_command",
+    "open_shell",
+    "run_command",
+    "send_input",
+    "receive",
+    "cleanup_command",
+    "close_shell",
+    "remote_execution",
+    "decompress_output",
+    "decode_output",
+)
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+)
+
+LATENCY_BUCKET_LABELS = tuple("{0:g}".format(bound) for bound in LATENCY_BUCKETS) + (
+    "+Inf",
+)
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+LATENCY_ROW_FORMAT = "{0:<40} {1:>8} {2:>10} {3:>10} {4:>10}"
+
+
+def _get_current_operation_name(host):
+    op_hash = getattr(host, "executing_op_hash", None) or getattr(
+        host, "current_op_hash", None
+    )
+    if op_hash is None or host.state is None:
+        return None
+    return ", ".join(sorted(host.state.get_op_meta(op_hash).names)) or "Operation"
+
+
+def _format_counters(name, counters):
+    upload_rate = 0.0
+    if counters["upload_seconds"]:
+        upload_rate = counters["upload_bytes"] / counters["upload_seconds"] / 1024
+
+    return ROW_FORMAT.format(
+        name[:40],
+        counters["commands"],
+        counters["soap_requests"],
+        counters["shells_opened"],
+        counters["powershell_launches"],
+        counters["bytes_sent"] // 1024,
+        counters["bytes_received"] // 1024,
+        "{0:.1f}".format(upload_rate),
+        "{0:.2f}".format(counters["wall_seconds"]),
+        "{0:.2f}".format(counters["remote_seconds"]),
+    )
+
+
+class LatencyHistogram:
+    """
+    Fixed bucket histogram of durations, like a Prometheus histogram.
+    """
+
+    def __init__(self):
+        # The last bucket is +Inf
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        for i, count in enumerate(other.buckets):
+            self.buckets[i] += count
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """
+        Estimate a quantile by interpolating within its bucket, capped to the
+        largest observed value.
+        """
+
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            if count and seen + count >= rank:
+                lower = LATENCY_BUCKETS[i - 1] if i > 0 else 0.0
+                upper = LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else self.max
+                upper = min(upper, self.max)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+    def to_dict(self):
+        data = {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+        }
+        for q in QUANTILES:
+            data["p{0}".format(round(q * 100))] = self.quantile(q)
+        data["buckets"] = dict(zip(LATENCY_BUCKET_LABELS, self.buckets))
+        return data
+
+
+def _prometheus_labels(**labels):
+    return ",".join(
+        '{0}="{1}"'.format(
+            key,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for key, value in labels.items()
+    )
+
+
+class WinRMStats:
+    """
+    Counters for each host, split by the operation or fact that caused them, and
+    latency histograms for each host and phase.
+
+    Only facts loaded through ``host.get_fact`` are told apart, facts loaded with
+    ``pyinfra.api.facts.get_facts`` (the ``pyinfra ... fact`` command) are counted
+    under the ``Other`` operation.
+    """
+
+    def __init__(self):
+        self.hosts: dict[str, dict] = {}
+        self.latencies: dict[str, dict[str, LatencyHistogram]] = {}
+        self.report_filename: str | None = None
+
+    def _get_host_stats(self, host_name):
+        if host_name not in self.hosts:
+            self.hosts[host_name] = {
+                "total": Counter(),
+                "operations": {},
+                "facts": {},
+            }
+        return self.hosts[host_name]
+
+    def record(self, host, counters):
+        host_stats = self._get_host_stats(host.name)
+        host_stats["total"].update(counters)
+
+        fact_name = get_current_fact_name()
+        if fact_name is not None:
+            scope, name = "facts", fact_name
+        else:
+            scope, name = "operations", _get_current_operation_name(host) or "Other"
+
+        host_stats[scope].setdefault(name, Counter()).update(counters)
+
+    def record_timings(self, host, timings):
+        """
+        Add ``(phase, seconds)`` timings to the host's latency histograms.
+        """
+
+        host_latencies = self.latencies.setdefault(host.name, {})
+        for phase, seconds in timings:
+            if phase not in host_latencies:
+                host_latencies[phase] = LatencyHistogram()
+            host_latencies[phase].observe(seconds)
+
+    def _sorted_phases(self, latencies):
+        return sorted(
+            latencies,
+            key=lambda phase: PHASES.index(phase) if phase in PHASES else len(PHASES),
+        )
+
+    def to_dict(self):
+        return {
+            host_name: {
+                "total": {key: host_stats["total"][key] for key in COUNTERS},
+                "operations": {
+                    name: {key: counters[key] for key in COUNTERS}
+                    for name, counters in host_stats["operations"].items()
+                },
+                "facts": {
+                    name: {key: counters[key] for key in COUNTERS}
+                    for name, counters in host_stats["facts"].items()
+                },
+                "latency": {
+                    phase: self.latencies[host_name][phase].to_dict()
+                    for phase in self._sorted_phases(self.latencies.get(host_name, {}))
+                },
+            }
+            for host_name, host_stats in self.hosts.items()
+        }
+
+    def to_prometheus(self):
+        lines = []
+
+        for key in COUNTERS:
+            metric = "pyinfra_winrm_{0}_total".format(key)
+            lines.append("# TYPE {0} counter".format(metric))
+            for host_name, host_stats in sorted(self.hosts.items()):
+                lines.append(
+                    "{0}{{{1}}} {2}".format(
+                        metric,
+                        _prometheus_labels(host=host_name),
+                        host_stats["total"][key],
+                    ),
+                )
+
+        metric = "pyinfra_winrm_phase_seconds"
+        lines.append("# TYPE {0} histogram".format(metric))
+        for host_name, host_latencies in sorted(self.latencies.items()):
+            for phase in self._sorted_phases(host_latencies):
+                histogram = host_latencies[phase]
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKET_LABELS, histogram.buckets):
+                    cumulative += count
+                    lines.append(
+                        "{0}_bucket{{{1}}} {2}".format(
+                            metric,
+                            _prometheus_labels(
+                                host=host_name,
+                                phase=phase,
+                                le=bound,
+                            ),
+                            cumulative,
+                        ),
+                    )
+                labels = _prometheus_labels(host=host_name, phase=phase)
+                lines.append("{0}_sum{{{1}}} {2}".format(metric, labels, histogram.sum))
+                lines.append(
+                    "{0}_count{{{1}}} {2}".format(metric, labels, histogram.count),
+                )
+
+        return "\n".join(lines) + "\n"
+
+    def format_table(self):
+        lines = [
+            ROW_FORMAT.format(
+                "",
+                "commands",
+                "soap",
+                "shells",
+                "ps",
+                "sent KB",
+                "recv KB",
+                "up KB/s",
+                "wall s",
+                "remote s",
+            ),
+        ]
+        for host_name, host_stats in sorted(self.hosts.items()):
+            lines.append(_format_counters(host_name, host_stats["total"]))
+
+        # Operations & facts across all hosts, most expensive first
+        for scope in ("operations", "facts"):
+            totals: dict[str, Counter] = {}
+            for host_stats in self.hosts.values():
+                for name, counters in host_stats[scope].items():
+                    totals.setdefault(name, Counter()).update(counters)
+
+            if totals:
+                lines.append("")
+                lines.append(scope.capitalize())
+                for name, counters in sorted(
+                    totals.items(),
+                    key=lambda item: item[1]["wall_seconds"],
+                    reverse=True,
+                ):
+                    lines.append(_format_counters(name, counters))
+
+        # Latency of each phase across all hosts
+        phase_totals: dict[str, LatencyHistogram] = {}
+        for host_latencies in self.latencies.values():
+            for phase, histogram in host_latencies.items():
+                phase_totals.setdefault(phase, LatencyHistogram()).merge(histogram)
+
+        if phase_totals:
+            lines.append("")
+            lines.append(
+                LATENCY_ROW_FORMAT.format(
+                    "Latency", "count", "p50 ms", "p95 ms", "p99 ms"
+                )
+            )
+            for phase in self._sorted_phases(phase_totals):
+                histogram = phase_totals[phase]
+                lines.append(
+                    LATENCY_ROW_FORMAT.format(
+                        phase,
+                        histogram.count,
+                        *(
+                            "{0:.1f}".format(histogram.quantile(q) * 1000)
+                            for q in QUANTILES
+                        ),
+                    ),
+                )
+
+        return "\n".join(lines)
+
+    def enable_report(self, filename):
+        if self.report_filename is None:
+            atexit.register(self.write_report)
+        self.report_filename = filename
+
+    def write_report(self):
+        if not self.report_filename or not self.hosts:
+            return
+
+        click.echo("--> WinRM usage:", err=True)
+        click.echo(self.format_table(), err=True)
+
+        with open(self.report_filename, "w", encoding="utf-8") as f:
+            if self.report_filename.endswith(".prom"):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), f, indent=4)
+
+
+winrm_stats = WinRMStats()
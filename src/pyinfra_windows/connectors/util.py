@@ -1,3 +1,6 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
 # import shlex
 
 
@@ -18,3 +21,51 @@ def make_win_command(command):
     # command = mslex.quote(str(command))
     # command = "{0}".format(command)
     return str(command)
+
+
+def quote_ps_string(value):
+    """
+    Quotes a value as a literal (single quoted) PowerShell string.
+    """
+
+    return "'{0}'".format(str(value).replace("'", "''"))
+
+
+# Name of the fact being loaded through a connector wrapped host's get_fact
+_current_fact_name: ContextVar[str | None] = ContextVar(
+    "current_fact_name",
+    default=None,
+)
+
+
+@contextmanager
+def loading_fact(name):
+    """
+    Marks the commands run within as loading the named fact.
+    """
+
+    token = _current_fact_name.set(name)
+    try:
+        yield
+    finally:
+        _current_fact_name.reset(token)
+
+
+def wrap_get_fact(get_fact):
+    """
+    Wraps a host's ``get_fact`` to mark the commands it runs as loading the fact.
+    """
+
+    def get_fact_wrapper(name_or_cls, *args, **kwargs):
+        with loading_fact(getattr(name_or_cls, "name", None)):
+            return get_fact(name_or_cls, *args, **kwargs)
+
+    return get_fact_wrapper
+
+
+def get_current_fact_name():
+    """
+    Returns the name of the fact being loaded, if any.
+    """
+
+    return _current_fact_name.get()
@@ -36,8 +36,11 @@ Examples using ``@winrm``:
 
 from __future__ import annotations
 
+from os import makedirs, path
+from time import perf_counter, time
 from typing import TYPE_CHECKING
 import base64
+import json
 import ntpath
 
 import click
@@ -50,11 +53,28 @@ from pyinfra.api.util import get_file_io, memoize, sha1_hash
 from pyinfra.connectors.base import BaseConnector, DataMeta
 from pyinfra.connectors.util import read_output_buffers
 from .pyinfrawinrmsession import PyinfraWinrmSession
-from .util import make_win_command
+from .stats import winrm_stats
+from .util import (
+    get_current_fact_name,
+    make_win_command,
+    quote_ps_string,
+    wrap_get_fact,
+)
 
 if TYPE_CHECKING:
     from pyinfra.api.arguments import ConnectorArguments
 
+# Writes base64 encoded lines from standard input to a file
+UPLOAD_SCRIPT = (
+    "$ErrorActionPreference = 'Stop'; $file = [IO.File]::Create({0}); "
+    "try {{ foreach ($line in $input) {{ $data = [Convert]::FromBase64String($line); "
+    "$file.Write($data, 0, $data.Length) }} }} finally {{ $file.Dispose() }}"
+)
+
+# Bytes per Send request when uploading, which once base64 encoded twice (by us and
+# in the SOAP message) stays under the default 150KB WinRM MaxEnvelopeSize
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
 
 class ConnectorData(TypedDict):
     winrm_hostname: str
@@ -64,6 +84,11 @@ class ConnectorData(TypedDict):
     transport: str
     read_timeout_sec: int
     operation_timeout_sec: int
+    winrm_stats_report: str
+    winrm_remote_timing: bool
+    winrm_compress_output: bool | list[str]
+    winrm_conditional_facts: bool | list[str]
+    winrm_output_cache_dir: str
 
 
 connector_data_meta: dict[str, DataMeta] = {
@@ -74,6 +99,29 @@ connector_data_meta: dict[str, DataMeta] = {
     "transport": DataMeta("WinRM transport"),
     "read_timeout_sec": DataMeta("Read timeout in seconds"),
     "operation_timeout_sec": DataMeta("Operation timeout in seconds"),
+    "winrm_stats_report": DataMeta(
+        "Write a report of WinRM requests/bytes/latencies to this file at exit "
+        "(JSON, or Prometheus text if the filename ends with .prom). Facts are "
+        "only reported separately when loaded through host.get_fact, not by the "
+        "pyinfra fact command"
+    ),
+    "winrm_remote_timing": DataMeta(
+        "Time PowerShell commands on the target to separate execution from transport"
+    ),
+    "winrm_compress_output": DataMeta(
+        "Gzip the output of PowerShell commands on the target, either all (True) "
+        "or only for a list of fact names (eg server.Services). Output is formatted "
+        "with Out-String first, and lost if the command calls exit. A list only "
+        "matches facts loaded through host.get_fact, not by the pyinfra fact command"
+    ),
+    "winrm_conditional_facts": DataMeta(
+        "Only transfer fact output when it changed since last fetched, for all "
+        "facts (True) or a list of fact names. Only applies to facts loaded through "
+        "host.get_fact, not by the pyinfra fact command"
+    ),
+    "winrm_output_cache_dir": DataMeta(
+        "Keep the outputs cached for winrm_conditional_facts in this directory"
+    ),
 }
 
 
@@ -119,6 +167,16 @@ class WinRMConnector(BaseConnector):
 
     session = None
 
+    def __init__(self, state, host):
+        super().__init__(state, host)
+        # Command -> (output hash, stdout) for winrm_conditional_facts
+        self.output_cache: dict[str, tuple[str, bytes]] = {}
+        # pyinfra doesn't tell connectors which fact a command is for, and the only
+        # code all fact loads share is its private _get_fact. So note the facts
+        # loaded through the host, for the stats and per fact settings. Facts loaded
+        # with pyinfra.api.facts.get_facts (the fact CLI command) aren't seen.
+        host.get_fact = wrap_get_fact(host.get_fact)
+
     data: ConnectorData
     data_cls = ConnectorData
     data_meta = connector_data_meta
@@ -159,6 +217,11 @@ class WinRMConnector(BaseConnector):
                 operation_timeout_sec=kwargs["winrm_operation_timeout_sec"],
             )
             self.session = session
+
+            stats_report = self.host.data.get("winrm_stats_report")
+            if stats_report:
+                winrm_stats.enable_report(stats_report)
+
             return session
 
         # TODO: add exceptions here
@@ -175,6 +238,65 @@ class WinRMConnector(BaseConnector):
             logger.debug("%s", e)
             _raise_connect_error(self.host, "Authentication error", auth_args)
 
+    def disconnect(self):
+        """
+        Close the HTTP session to the host, if any.
+        """
+        if self.session is not None:
+            self.session.protocol.transport.close_session()
+            self.session = None
+
+    def _is_enabled_for_fact(self, key, facts_only=False):
+        """
+        Check host data that is either a bool, or a list of fact names (eg
+        ``server.Services``) to enable something for.
+        """
+        setting = self.host.data.get(key)
+        if not setting:
+            return False
+
+        fact_name = get_current_fact_name()
+        if not isinstance(setting, (list, tuple, set)):
+            return fact_name is not None or not facts_only
+
+        return fact_name is not None and any(
+            fact_name == name or fact_name.endswith(".{0}".format(name))
+            for name in setting
+        )
+
+    def _get_output_cache_filename(self, command):
+        cache_dir = self.host.data.get("winrm_output_cache_dir")
+        if not cache_dir:
+            return None
+        return path.join(
+            cache_dir,
+            "{0}.json".format(sha1_hash("{0}\n{1}".format(self.host.name, command))),
+        )
+
+    def _get_cached_output(self, command):
+        """
+        Returns the ``(hash, stdout)`` last seen for a command, if any.
+        """
+        if command in self.output_cache:
+            return self.output_cache[command]
+
+        filename = self._get_output_cache_filename(command)
+        if filename and path.exists(filename):
+            with open(filename, encoding="utf-8") as f:
+                data = json.load(f)
+            self.output_cache[command] = (data["hash"], data["output"].encode("utf-8"))
+            return self.output_cache[command]
+        return None
+
+    def _set_cached_output(self, command, output_hash, std_out):
+        self.output_cache[command] = (output_hash, std_out)
+
+        filename = self._get_output_cache_filename(command)
+        if filename:
+            makedirs(path.dirname(filename), exist_ok=True)
+            with open(filename, "w", encoding="utf-8") as f:
+                json.dump({"hash": output_hash, "output": std_out.decode("utf-8")}, f)
+
     def run_shell_command(
         self,
         command,
@@ -230,15 +352,55 @@ class WinRMConnector(BaseConnector):
             shell_executable = "ps"
         logger.debug("shell_executable:%s", shell_executable)
 
+        counters = self.session.counters.copy()  # type: ignore
+        start = time()
+
         # we use our own subclassed session that allows for env setting from open_shell.
         if shell_executable in ["cmd"]:
             response = self.session.run_cmd(tmp_command, env=env)  # type: ignore
         else:
-            response = self.session.run_ps(tmp_command, env=env)  # type: ignore
+            conditional_output = self._is_enabled_for_fact(
+                "winrm_conditional_facts",
+                facts_only=True,
+            )
+            cached_output = (
+                self._get_cached_output(tmp_command) if conditional_output else None
+            )
+            response = self.session.run_ps(  # type: ignore
+                tmp_command,
+                env=env,
+                remote_timing=bool(self.host.data.get("winrm_remote_timing")),
+                compress_output=self._is_enabled_for_fact("winrm_compress_output"),
+                conditional_output=conditional_output,
+                known_output_hash=cached_output[0] if cached_output else None,
+            )
+
+            # Failed commands may have written partial output, never cache it
+            if conditional_output and response.status_code == 0:
+                if response.output_unchanged and cached_output:
+                    response.std_out = cached_output[1]
+                    self.session.counters["unchanged_outputs"] += 1  # type: ignore
+                elif response.output_hash:
+                    self._set_cached_output(
+                        tmp_command,
+                        response.output_hash,
+                        response.std_out,
+                    )
+
+        counters = self.session.counters - counters  # type: ignore
+        counters.update(commands=1, wall_seconds=time() - start)
+
+        timings = self.session.timings  # type: ignore
+        remote_seconds = getattr(response, "remote_seconds", None)
+        if remote_seconds is not None:
+            counters["remote_seconds"] += remote_seconds
+            timings.append(("remote_execution", remote_seconds))
+        winrm_stats.record(self.host, counters)
 
         return_code = response.status_code
         logger.debug("response:%s", response)
 
+        decode_start = perf_counter()
         std_out_str = response.std_out.decode("utf-8")
         std_err_str = response.std_err.decode("utf-8")
 
@@ -246,6 +408,10 @@ class WinRMConnector(BaseConnector):
         std_out = std_out_str.split("\r\n")
         std_err = std_err_str.split("\r\n")
 
+        timings.append(("decode_output", perf_counter() - decode_start))
+        winrm_stats.record_timings(self.host, timings)
+        timings.clear()
+
         logger.debug("std_out:%s", std_out)
         logger.debug("std_err:%s", std_err)
 
@@ -280,26 +446,44 @@ class WinRMConnector(BaseConnector):
     ):
         raise PyinfraError("Not implemented")
 
-    def _put_file(self, filename_or_io, remote_location, chunk_size=2048):
-        # this should work fine on smallish files, but there will be perf issues
-        # on larger files both due to the full read, the base64 encoding, and
-        # the latency when sending chunks
+    def _put_file(self, filename_or_io, remote_location, chunk_size=UPLOAD_CHUNK_SIZE):
+        # The file is streamed to a single PowerShell process, base64 encoded on its
+        # standard input, rather than starting one process per chunk
+        counters = self.session.counters.copy()  # type: ignore
+        start = time()
+        uploaded = 0
+
         with get_file_io(filename_or_io) as file_io:
-            data = file_io.read()
-            for i in range(0, len(data), chunk_size):
-                chunk = data[i : i + chunk_size]
-                ps = (
-                    '$data = [System.Convert]::FromBase64String("{0}"); '
-                    '{1} -Value $data -Encoding byte -Path "{2}"'
-                ).format(
-                    base64.b64encode(chunk).decode("utf-8"),
-                    "Set-Content" if i == 0 else "Add-Content",
-                    remote_location,
-                )
-                status, _stdout, stderr = self.run_shell_command(ps)
-                if status is False:
-                    logger.error("File upload error: {0}".format("\n".join(stderr)))
-                    return False
+
+            def read_chunks():
+                nonlocal uploaded
+                while True:
+                    chunk = file_io.read(chunk_size)
+                    if not chunk:
+                        break
+                    uploaded += len(chunk)
+                    yield base64.b64encode(chunk) + b"\r\n"
+
+            response = self.session.run_ps_with_input(  # type: ignore
+                UPLOAD_SCRIPT.format(quote_ps_string(remote_location)),
+                read_chunks(),
+            )
+
+        counters = self.session.counters - counters  # type: ignore
+        counters.update(
+            commands=1,
+            upload_bytes=uploaded,
+            upload_seconds=time() - start,
+        )
+        winrm_stats.record(self.host, counters)
+        winrm_stats.record_timings(self.host, self.session.timings)  # type: ignore
+        self.session.timings.clear()  # type: ignore
+
+        if response.status_code != 0:
+            logger.error(
+                "File upload error: {0}".format(response.std_err.decode("utf-8")),
+            )
+            return False
 
         return True
 
@@ -313,7 +497,8 @@ class WinRMConnector(BaseConnector):
         **command_kwargs,
     ):
         """
-        Upload file by chunking and sending base64 encoded via winrm
+        Upload file by streaming it base64 encoded to a single PowerShell process
+        over winrm
         """
 
         # TODO: fix this? Workaround for circular import
@@ -332,7 +517,7 @@ class WinRMConnector(BaseConnector):
         command = "Move-Item -Path {0} -Destination {1} -Force".format(
             temp_file, remote_filename
         )
-        status, _, stderr = self.run_shell_command(
+        status, output = self.run_shell_command(
             command,
             print_output=print_output,
             print_input=print_input,
@@ -340,7 +525,9 @@ class WinRMConnector(BaseConnector):
         )
 
         if status is False:
-            logger.error("File upload error: {0}".format("\n".join(stderr)))
+            logger.error(
+                "File upload error: {0}".format("\n".join(output.stderr_lines)),
+            )
             return False
 
         if print_output:
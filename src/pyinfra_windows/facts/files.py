@@ -1,5 +1,10 @@
+import base64
+from datetime import datetime, timedelta
+
 from pyinfra.api.facts import FactBase
 
+from pyinfra_windows.connectors.util import quote_ps_string
+
 from .util.win_files import parse_win_ls_output
 
 
@@ -90,3 +95,244 @@ class Md5File(FactBase):
 
     def process(self, output):
         return output[0] if len(output[0]) > 0 else None
+
+
+class FileHashes(FactBase):
+    """
+    Returns the hashes of a file for each of the given algorithms, reading the file
+    only once:
+
+    .. code:: python
+
+        {
+            "SHA1": "4E1243BD22C66E76C2BA9EDDC1F91394E57F9F83",
+            "MD5": "D8E8FCA2DC0F896FD7CB4CB0031BA249",
+        }
+    """
+
+    shell_executable = "ps"
+
+    def command(self, path, algorithms=("SHA1", "SHA256", "MD5")):
+        return (
+            'if (Test-Path "{0}") {{ '
+            '$path = (Get-Item "{0}").FullName; $buffer = New-Object byte[] 1MB; '
+            "$hashers = [ordered]@{{}}; "
+            "foreach ($name in {1}) {{ "
+            "$hashers[$name] = [Security.Cryptography.HashAlgorithm]::Create($name) }}; "
+            "$file = [IO.File]::OpenRead($path); "
+            "try {{ while (($read = $file.Read($buffer, 0, $buffer.Length)) -gt 0) {{ "
+            "foreach ($hasher in $hashers.Values) {{ "
+            "[void]$hasher.TransformBlock($buffer, 0, $read, $null, 0) }} }} }} "
+            "finally {{ $file.Dispose() }}; "
+            "foreach ($name in $hashers.Keys) {{ "
+            "[void]$hashers[$name].TransformFinalBlock($buffer, 0, 0); "
+            "\"$name \" + [BitConverter]::ToString($hashers[$name].Hash).Replace('-', '') }} }}"
+        ).format(path, ", ".join("'{0}'".format(name) for name in algorithms))
+
+    def process(self, output):
+        hashes = {}
+        for line in output:
+            if line:
+                name, value = line.split(" ", 1)
+                hashes[name] = value.strip()
+        return hashes or None
+
+
+class FindFiles(FactBase):
+    """
+    Returns the files under a directory matching a pattern, filtered on the target
+    as the directories are enumerated:
+
+    .. code:: python
+
+        [
+            {
+                "path": "C:\\logs\\app\\app-20240102.log",
+                "size": 1048576,
+                "mtime": datetime(2024, 1, 2, 3, 4, 5),
+            },
+        ]
+
+    + path: directory to search
+    + pattern: file name wildcard pattern, eg ``*.log``
+    + recursive: whether to search subdirectories
+    + min_size: only return files of at least this many bytes
+    + older_than: only return files last modified more than this many seconds (or
+      ``timedelta``) ago
+    + max_results: stop after finding this many files
+
+    Modification times are UTC. Directories that can't be read are skipped, and
+    links to directories aren't followed.
+    """
+
+    shell_executable = "ps"
+
+    default = list
+
+    def command(
+        self,
+        path,
+        pattern="*",
+        recursive=True,
+        min_size=None,
+        older_than=None,
+        max_results=None,
+    ):
+        setup = ""
+        skip_conditions = []
+        if min_size:
+            skip_conditions.append("$file.Length -lt {0}".format(int(min_size)))
+        if older_than is not None:
+            if isinstance(older_than, timedelta):
+                older_than = older_than.total_seconds()
+            setup = "$before = [DateTime]::UtcNow.AddSeconds(-{0}); ".format(
+                int(older_than),
+            )
+            skip_conditions.append("$file.LastWriteTimeUtc -gt $before")
+
+        skip_file = ""
+        if skip_conditions:
+            skip_file = "if ({0}) {{ continue }}; ".format(
+                " -or ".join(skip_conditions)
+            )
+
+        stop_search = ""
+        if max_results:
+            stop_search = "; $count++; if ($count -ge {0}) {{ break search }}".format(
+                int(max_results),
+            )
+
+        push_directories = ""
+        if recursive:
+            push_directories = (
+                "; foreach ($child in $directory.EnumerateDirectories()) { "
+                "if (-not ($child.Attributes -band [IO.FileAttributes]::ReparsePoint)) "
+                "{ $directories.Push($child) } }"
+            )
+
+        # DirectoryInfo enumeration reads the size and times along with the names,
+        # without a call per file.
+        return (
+            "$root = New-Object IO.DirectoryInfo {0}; if ($root.Exists) {{ "
+            "{1}$count = 0; "
+            "$directories = New-Object Collections.Generic.Stack[IO.DirectoryInfo]; "
+            "$directories.Push($root); "
+            ":search while ($directories.Count) {{ $directory = $directories.Pop(); "
+            "try {{ foreach ($file in $directory.EnumerateFiles({2})) {{ {3}"
+            '"{{0}}`t{{1}}`t{{2}}" -f $file.Length, '
+            "$file.LastWriteTimeUtc.ToString('s'), $file.FullName{4} }}{5} }} "
+            "catch [UnauthorizedAccessException], [IO.IOException] {{ }} }} }}"
+        ).format(
+            quote_ps_string(path),
+            setup,
+            quote_ps_string(pattern),
+            skip_file,
+            stop_search,
+            push_directories,
+        )
+
+    def process(self, output):
+        files = []
+        for line in output:
+            if line:
+                size, mtime, path = line.split("\t", 2)
+                files.append(
+                    {
+                        "path": path,
+                        "size": int(size),
+                        "mtime": datetime.fromisoformat(mtime),
+                    },
+                )
+        return files
+
+
+class FileContents(FactBase):
+    """
+    Returns a range of a file's contents, read on the target so only that range is
+    transferred:
+
+    .. code:: python
+
+        {
+            "size": 10485760,
+            "offset": 10485000,
+            "end": 10485760,
+            "truncated": False,
+            "content": "2024-01-02 03:04:05 INFO Started\\r\\n...",
+        }
+
+    + path: path of the file
+    + offset: byte offset to read from
+    + length: read at most this many bytes
+    + tail_lines: only return the last this many lines (of the range, when
+      ``length`` is also set the last ``length`` bytes of those lines)
+    + encoding: decode the content with this encoding, ``None`` returns bytes
+
+    Cursor:
+        ``end`` is the offset just after the returned content. Pass it as ``offset``
+        to fetch only the bytes appended since, eg to follow a log file. When the
+        file is now smaller than ``offset`` (eg it was rotated) it is read from the
+        start and ``truncated`` is set.
+
+    The file is opened without blocking writers. Ranges split on byte offsets, so
+    decoding replaces any partial characters at either end.
+    """
+
+    shell_executable = "ps"
+
+    def command(self, path, offset=0, length=None, tail_lines=None, encoding="utf-8"):
+        self.encoding = encoding
+
+        find_range = ""
+        if length is not None:
+            if tail_lines:
+                # Only the last bytes of the lines are wanted
+                find_range = "$start = [Math]::Max($start, $end - {0}); "
+            else:
+                find_range = "$end = [Math]::Min($size, $start + {0}); "
+            find_range = find_range.format(int(length))
+        if tail_lines:
+            # Search back from the end for the newlines, ignoring a final one
+            find_range = (
+                "{0}$block = New-Object byte[] 64KB; $position = $end; $lines = 0; "
+                ":scan while ($position -gt $start) {{ "
+                "$read = [Math]::Min($block.Length, $position - $start); "
+                "$position -= $read; $stream.Position = $position; "
+                "[void]$stream.Read($block, 0, $read); $i = $read - 1; "
+                "while ($i -ge 0) {{ $i = [Array]::LastIndexOf($block, [byte]10, $i, $i + 1); "
+                "if ($i -lt 0) {{ break }}; "
+                "if ($position + $i -lt $end - 1) {{ $lines++; "
+                "if ($lines -ge {1}) {{ $start = $position + $i + 1; break scan }} }}; "
+                "$i-- }} }}; "
+            ).format(find_range, int(tail_lines))
+
+        return (
+            "$path = {0}; if (Test-Path -LiteralPath $path -PathType Leaf) {{ "
+            "$stream = [IO.File]::Open((Get-Item -LiteralPath $path).FullName, "
+            "'Open', 'Read', 'ReadWrite'); "
+            "try {{ $size = $stream.Length; $start = {1}; "
+            "$truncated = $start -gt $size; if ($truncated) {{ $start = 0 }}; "
+            "$end = $size; {2}"
+            "$buffer = New-Object byte[] ($end - $start); $stream.Position = $start; "
+            "[void]$stream.Read($buffer, 0, $buffer.Length); "
+            '"$size $start $end $truncated"; [Convert]::ToBase64String($buffer) }} '
+            "finally {{ $stream.Dispose() }} }}"
+        ).format(quote_ps_string(path), int(offset or 0), find_range)
+
+    def process(self, output):
+        lines = [line for line in output if line]
+        if not lines:
+            return None
+
+        size, start, end, truncated = lines[0].split()
+        content = base64.b64decode("".join(lines[1:]))
+        if self.encoding:
+            content = content.decode(self.encoding, "replace")
+
+        return {
+            "size": int(size),
+            "offset": int(start),
+            "end": int(end),
+            "truncated": truncated == "True",
+            "content": content,
+        }
@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import json
+
+from pyinfra.api import FactBase
+
+from pyinfra_windows.connectors.util import quote_ps_string
+
+
+class RegistryValues(FactBase):
+    """
+    Returns the values of many registry keys in a single call, with their types and
+    ``None`` for any missing key or value:
+
+    .. code:: python
+
+        {
+            "HKLM:\\SOFTWARE\\Policies\\Microsoft\\Windows\\WindowsUpdate\\AU": {
+                "NoAutoUpdate": {"Type": "DWord", "Value": 1},
+                "AUOptions": None,
+            },
+            "HKLM:\\SOFTWARE\\Missing": None,
+        }
+
+    + keys: list of registry key paths to read all values of, or a dict of key path
+      to the list of value names to read
+
+    Types are ``String``, ``ExpandString``, ``Binary`` (a list of bytes), ``DWord``,
+    ``QWord`` and ``MultiString`` (a list of strings). ``ExpandString`` values are
+    returned unexpanded.
+    """
+
+    shell_executable = "ps"
+
+    def command(self, keys):
+        self.keys = keys
+        if not isinstance(keys, dict):
+            keys = {key: None for key in keys}
+
+        return (
+            "foreach ($key in @({0})) {{ "
+            "$item = Get-Item -LiteralPath $key.Path -ErrorAction SilentlyContinue; "
+            "$values = [ordered]@{{}}; "
+            "if ($item) {{ $valueNames = $item.GetValueNames(); "
+            "$names = if ($key.Names.Count) {{ $key.Names }} else {{ $valueNames }}; "
+            "foreach ($name in $names) {{ if ($valueNames -contains $name) {{ "
+            "$values[$name] = @{{Type = $item.GetValueKind($name).ToString(); "
+            "Value = $item.GetValue($name, $null, 'DoNotExpandEnvironmentNames')}} }} }} }}; "
+            "ConvertTo-Json -Compress -Depth 4 -InputObject @{{"
+            "Path = $key.Path; Exists = [bool]$item; Values = $values}} }}"
+        ).format(
+            ", ".join(
+                "@{{Path = {0}; Names = @({1})}}".format(
+                    quote_ps_string(key),
+                    ", ".join(quote_ps_string(name) for name in names or []),
+                )
+                for key, names in keys.items()
+            ),
+        )
+
+    def process(self, output):
+        found = {}
+        for line in output:
+            if line:
+                info = json.loads(line)
+                found[info["Path"]] = info["Values"] if info["Exists"] else None
+
+        registry_values = {}
+        for key in self.keys:
+            values = found.get(key)
+            if values is not None and isinstance(self.keys, dict):
+                # Registry value names are case insensitive
+                values_lower = {name.lower(): value for name, value in values.items()}
+                values = {
+                    name: values_lower.get(name.lower()) for name in self.keys[key]
+                }
+            registry_values[key] = values
+        return registry_values
@@ -0,0 +1,258 @@
+"""
+Parsing of PowerShell ``Format-List`` output, which looks like:
+
+.. code::
+
+    Name        : Spooler
+    DisplayName : Print Spooler
+    Description : This service spools print jobs and handles interactio
+                  n with the printer.
+
+    Name        : W32Time
+    ...
+
+Property names start at the beginning of a line and are padded up to the
+`` : `` separator. Long values are wrapped onto indented continuation lines at
+the console width, wherever the width falls, and objects are separated by blank
+lines. The facts format their output as a wider string (see
+``facts.server.FORMAT_LIST``) so values aren't wrapped, any continuation lines
+left are joined as they are.
+"""
+
+from __future__ import annotations
+
+import sys
+from array import array
+from collections.abc import Mapping
+from typing import Iterable, Iterator
+
+SEPARATOR = " : "
+
+
+def iter_format_list_records(output: Iterable[str]) -> Iterator[dict[str, str]]:
+    """
+    Yield a dict of properties for each object in ``Format-List`` output, reading
+    the lines lazily.
+    """
+
+    record: dict[str, str] = {}
+    # Parts of values wrapped over several lines, joined once the object is done
+    continued: dict[str, list[str]] = {}
+    key = None
+
+    for line in output:
+        if not line or line.isspace():
+            if continued:
+                for continued_key, parts in continued.items():
+                    record[continued_key] = "".join(parts)
+                continued = {}
+            if record:
+                yield record
+                record = {}
+            key = None
+            continue
+
+        if not line[0].isspace():
+            name, separator, value = line.partition(SEPARATOR)
+            if not separator and line.rstrip().endswith(" :"):
+                # An empty value, with the trailing space trimmed
+                name, separator, value = line.rstrip()[:-2], SEPARATOR, ""
+            if separator:
+                key = name.strip()
+                record[key] = value.strip()
+                continue
+
+        # A continuation of the previous value
+        if key is not None:
+            parts = continued.get(key)
+            if parts is None:
+                parts = continued[key] = [record[key]]
+            parts.append(line.strip())
+
+    for continued_key, parts in continued.items():
+        record[continued_key] = "".join(parts)
+    if record:
+        yield record
+
+
+# Record values are stored as unsigned 16 or 32 bit codes, the low bits of which
+# say where the value is and the rest its index (or the value, for integers)
+CODE_BITS = 2
+CODE_MASK = (1 << CODE_BITS) - 1
+CODE_SHARED = 0  # in the builder's shared values
+CODE_INT = 1  # a decimal integer
+CODE_LOCAL = 2  # in the record's own joined strings
+CODE_OBJECT = 3  # in the record's own non-string values
+# Larger integers are shared or stored as strings, keeping most rows in 16 bits
+MAX_INLINE_INT = (1 << (16 - CODE_BITS)) - 1
+
+# Joins the strings stored by each record (values containing it go in objects)
+LOCAL_SEPARATOR = "\x1f"
+
+# Values of a property sampled to decide whether they are shared by records or
+# unique (counters, times: less than one in eight seen before) and better stored
+# by each record
+PROPERTY_SAMPLE_SIZE = 128
+
+# Limit on the shared values, past which new values are stored by each record
+MAX_SHARED_VALUES = 1 << 20
+
+
+class RecordSchema:
+    """
+    The property names shared by records, interned, with their positions and how
+    often each property had a value not shared yet.
+    """
+
+    __slots__ = ("keys", "positions", "values", "seen", "added", "local")
+
+    def __init__(self, keys: Iterable[str], values: list[str]):
+        self.keys = tuple(sys.intern(key) for key in keys)
+        self.positions = {key: i for i, key in enumerate(self.keys)}
+        self.values = values
+        self.seen = [0] * len(self.keys)
+        self.added = [0] * len(self.keys)
+        self.local = [False] * len(self.keys)
+
+
+class Record(Mapping):
+    """
+    A read-only dict-like record storing its values as an array of codes, with the
+    property names held once in a shared ``RecordSchema``.
+    """
+
+    __slots__ = ("schema", "row", "strings", "objects")
+
+    def __init__(
+        self,
+        schema: RecordSchema,
+        row: array,
+        strings: str | None = None,
+        objects: tuple | None = None,
+    ):
+        self.schema = schema
+        self.row = row
+        self.strings = strings
+        self.objects = objects
+
+    def __getitem__(self, key):
+        code = self.row[self.schema.positions[key]]
+        kind, index = code & CODE_MASK, code >> CODE_BITS
+        if kind == CODE_SHARED:
+            return self.schema.values[index]
+        if kind == CODE_INT:
+            return str(index)
+        if kind == CODE_LOCAL:
+            return self.strings.split(LOCAL_SEPARATOR)[index]
+        return self.objects[index]
+
+    def __contains__(self, key):
+        return key in self.schema.positions
+
+    def __iter__(self):
+        return iter(self.schema.keys)
+
+    def __len__(self):
+        return len(self.schema.keys)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def to_json(self):
+        return dict(self)
+
+
+def _is_inline_int(value: str) -> bool:
+    return (
+        0 < len(value) <= 5
+        and value.isascii()
+        and value.isdigit()
+        and (value[0] != "0" or value == "0")
+        and int(value) <= MAX_INLINE_INT
+    )
+
+
+class RecordBuilder:
+    """
+    Builds compact records from dicts, sharing schemas between records with the
+    same properties and a single copy of each value seen in many records. Small
+    integers are stored in the codes, and the values of properties that are
+    mostly unique in one string by each record.
+    """
+
+    def __init__(self):
+        self.schemas: dict[tuple, RecordSchema] = {}
+        self.values: list[str] = []
+        self.indexes: dict[str, int] = {}
+
+    def _get_shared_index(self, schema: RecordSchema, position: int, value: str):
+        """
+        Returns the index of a shared value, or ``None`` to store it in the record.
+        """
+
+        if schema.local[position]:
+            return None
+
+        index = self.indexes.get(value)
+        if index is None:
+            schema.added[position] += 1
+        schema.seen[position] += 1
+
+        # Decide again for every sample, as properties repeating the values of
+        # another one only stop sharing them once that one does
+        if schema.seen[position] == PROPERTY_SAMPLE_SIZE:
+            if schema.added[position] * 8 > PROPERTY_SAMPLE_SIZE * 7:
+                schema.local[position] = True
+            schema.seen[position] = schema.added[position] = 0
+
+        if index is None:
+            if schema.local[position] or len(self.values) >= MAX_SHARED_VALUES:
+                return None
+            index = self.indexes[value] = len(self.values)
+            self.values.append(value)
+        return index
+
+    def build(self, record: dict[str, str]) -> Record:
+        keys = tuple(record)
+        schema = self.schemas.get(keys)
+        if schema is None:
+            schema = self.schemas[keys] = RecordSchema(keys, self.values)
+
+        codes = []
+        strings: dict[str, int] = {}
+        objects: list = []
+        for position, value in enumerate(record.values()):
+            # Values from JSON may also be lists
+            if not isinstance(value, str) or LOCAL_SEPARATOR in value:
+                code = (len(objects) << CODE_BITS) | CODE_OBJECT
+                objects.append(value)
+            elif _is_inline_int(value):
+                code = (int(value) << CODE_BITS) | CODE_INT
+            else:
+                index = self._get_shared_index(schema, position, value)
+                if index is None:
+                    # Properties often repeat a value (WorkingSet & WorkingSet64)
+                    index = strings.setdefault(value, len(strings))
+                    code = (index << CODE_BITS) | CODE_LOCAL
+                else:
+                    code = (index << CODE_BITS) | CODE_SHARED
+            codes.append(code)
+
+        return Record(
+            schema,
+            array("H" if max(codes, default=0) <= 0xFFFF else "I", codes),
+            LOCAL_SEPARATOR.join(strings) if strings else None,
+            tuple(objects) if objects else None,
+        )
+
+
+# Shared by all hosts, so that they share the schemas and values of their records
+_record_builder = RecordBuilder()
+
+
+def get_record_builder() -> RecordBuilder:
+    """
+    Returns the builder shared by the compact records of all facts and hosts.
+    """
+
+    return _record_builder
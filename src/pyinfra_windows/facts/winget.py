@@ -1,12 +1,17 @@
 from __future__ import annotations
 
+import json
+
 from typing_extensions import override
 
 from pyinfra.api import FactBase
 
-from pyinfra.facts.util.packaging import parse_packages
+from pyinfra_windows.connectors.util import quote_ps_string
 
-WINGET_REGEX = r"([^\s]+)\s+([^\s]+)"
+# File on the host caching the full package list, removed by ``winget.packages``
+WINGET_PACKAGES_CACHE = (
+    "(Join-Path ([IO.Path]::GetTempPath()) 'pyinfra-winget-packages.json')"
+)
 
 
 class WingetPackages(FactBase):
@@ -17,11 +22,37 @@ class WingetPackages(FactBase):
         {
             "package_name": ["version"],
         }
+
+    + package_ids: only return these packages
+    + cache_time: use the package list cached on the host if newer than this (in seconds)
+
+    Loading the ``Microsoft.WinGet.Client`` module takes seconds, so the full package
+    list is cached on the host each time this fact runs. The cache is removed by
+    ``winget.packages`` whenever it changes packages.
     """
 
     @override
-    def command(self) -> str:
-        return "Get-WingetPackage | Select -Property Id, InstalledVersion"
+    def command(self, package_ids=None, cache_time=None) -> str:
+        return (
+            "$cache = {cache}; $ids = @({ids}); "
+            "if ({cache_time} -and (Test-Path -LiteralPath $cache) -and "
+            "((Get-Date) - (Get-Item -LiteralPath $cache).LastWriteTime).TotalSeconds "
+            "-lt {cache_time}) {{ "
+            "$packages = Get-Content -Raw -LiteralPath $cache | ConvertFrom-Json "
+            "}} else {{ "
+            "$packages = @(Get-WinGetPackage | ForEach-Object {{ "
+            "[pscustomobject]@{{Id = $_.Id; Version = $_.InstalledVersion}} }}); "
+            "ConvertTo-Json -InputObject $packages -Compress | "
+            "Set-Content -LiteralPath $cache }}; "
+            "$packages | Where-Object {{ -not $ids -or $ids -contains $_.Id }} | "
+            "ForEach-Object {{ ConvertTo-Json -InputObject $_ -Compress }}"
+        ).format(
+            cache=WINGET_PACKAGES_CACHE,
+            ids=", ".join(
+                quote_ps_string(package_id) for package_id in package_ids or []
+            ),
+            cache_time=int(cache_time or 0),
+        )
 
     shell_executable = "ps"
 
@@ -29,4 +60,9 @@ class WingetPackages(FactBase):
 
     @override
     def process(self, output):
-        return parse_packages(WINGET_REGEX, output)
+        packages: dict[str, set[str]] = {}
+        for line in output:
+            if line:
+                package = json.loads(line)
+                packages.setdefault(package["Id"], set()).add(str(package["Version"]))
+        return packages
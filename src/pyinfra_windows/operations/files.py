@@ -6,21 +6,91 @@ import ntpath
 import os
 from datetime import timedelta
 
-from pyinfra import host, state
-from pyinfra.api import FileUploadCommand, OperationError, OperationTypeError, operation
-from pyinfra.api.util import get_file_sha1
+from pyinfra import host, logger, state
+from pyinfra.api import (
+    FileUploadCommand,
+    FunctionCommand,
+    OperationError,
+    OperationTypeError,
+    OperationValueError,
+    operation,
+)
+from pyinfra.api.util import get_file_sha1, get_file_sha256
 
 from pyinfra_windows.facts.server import Date
 from pyinfra_windows.facts.files import (
     Directory,
     File,
+    FileHashes,
     Link,
-    Md5File,
     Sha1File,
     Sha256File,
+    TempDir,
+)
+
+from .util.files import (
+    adjust_regex,
+    ensure_mode_int,
+    fetch_to_local_cache,
+    get_upload_semaphore,
+    make_cache_restore_command,
+    make_cache_store_command,
+    make_cache_trim_command,
+    make_download_command,
+    make_line_command,
+    make_replace_command,
 )
 
-from .util.files import ensure_mode_int
+
+def _get_artifact_cache_dir(cache_dir):
+    if cache_dir:
+        return cache_dir
+    return ntpath.join(host.get_fact(TempDir), "pyinfra-artifacts")
+
+
+def _cached_transfer(
+    sha256,
+    dest,
+    cache_dir,
+    cache_max_size,
+    transfer_commands,
+    verified=False,
+):
+    """
+    Copies ``dest`` out of the artifact cache if ``sha256`` is already stored on the
+    host, otherwise yields ``transfer_commands`` and stores the result. The cached
+    file is hashed when planning, and the stored file only if the transfer didn't
+    already check it against ``sha256`` on the host (``verified``).
+    """
+
+    cache_dir = _get_artifact_cache_dir(cache_dir)
+    cached_file = ntpath.join(cache_dir, sha256.lower())
+
+    # A cached file that doesn't match its name is overwritten by the store below
+    if (
+        host.get_fact(File, path=cached_file)
+        and (host.get_fact(Sha256File, path=cached_file) or "").lower()
+        == sha256.lower()
+    ):
+        yield make_cache_restore_command(cached_file, dest)
+        return
+
+    yield from transfer_commands
+    yield make_cache_store_command(cached_file, dest, None if verified else sha256)
+
+    if cache_max_size is not None:
+        yield make_cache_trim_command(cache_dir, cache_max_size)
+
+
+def _fetch_and_upload(state, host, src, dest, hashes, upload_concurrency):
+    try:
+        local_file = fetch_to_local_cache(src, hashes)
+    except (OSError, OperationError) as e:
+        logger.error("Failed to download {0}: {1}".format(src, e))
+        return False
+
+    with get_upload_semaphore(upload_concurrency):
+        return host.put_file(local_file, dest)
 
 
 @operation()
@@ -35,9 +105,16 @@ def download(
     sha256sum=None,
     sha1sum=None,
     md5sum=None,
+    segments=1,
+    retries=3,
+    cache=False,
+    cache_dir=None,
+    cache_max_size=None,
+    fetch_locally=False,
+    upload_concurrency=10,
 ):
     """
-    Download files from remote locations using curl or wget.
+    Download files from remote locations, streaming them to disk with resume support.
 
     + src: source URL of the file
     + dest: where to save the file
@@ -49,6 +126,35 @@ def download(
     + sha256sum: sha256 hash to checksum the downloaded file against
     + sha1sum: sha1 hash to checksum the downloaded file against
     + md5sum: md5 hash to checksum the downloaded file against
+    + segments: number of parallel ranges to fetch large files in
+    + retries: number of times to resume an interrupted download
+    + cache: satisfy the download from the artifact cache on the host (requires sha256sum)
+    + cache_dir: directory of the artifact cache, defaults to ``pyinfra-artifacts`` in the temp dir
+    + cache_max_size: size in bytes to trim the artifact cache to after adding a file
+    + fetch_locally: download once on the machine running pyinfra and upload to the host
+    + upload_concurrency: maximum number of hosts uploading a locally fetched file at once
+
+    Resuming:
+        The file is written to a ``.part`` file next to ``dest`` and only moved into
+        place once complete and verified. Interrupted transfers resume from the
+        current offset using HTTP ``Range`` requests, including a partial file left
+        behind by a previous run. Checksums are computed while the data is written.
+
+    ``segments``:
+        Only used when the server accepts ``Range`` requests and the file is at
+        least 8MB per segment, otherwise a single stream is used.
+
+    ``cache``:
+        Files are stored on the host by sha256, so downloading the same file to another
+        path (or again after a rollback) copies it from the cache instead of fetching
+        it. Least recently used files are removed once the cache is larger than
+        ``cache_max_size``, see also ``files.clean_artifact_cache``.
+
+    ``fetch_locally``:
+        For hosts without internet access, or to avoid every host hitting the same
+        origin. The file is fetched (and checksummed) once into a local cache directory
+        only readable by the current user and then uploaded to each host over the
+        connector.
 
     **Example:**
 
@@ -61,6 +167,9 @@ def download(
         )
     """
 
+    if cache and not sha256sum:
+        raise OperationError("The artifact cache requires sha256sum")
+
     info = host.get_fact(File, path=dest)
     # Destination is a directory?
     if info is False:
@@ -68,6 +177,14 @@ def download(
             "Destination {0} already exists and is not a file".format(dest),
         )
 
+    hashes = {}
+    if sha1sum:
+        hashes["SHA1"] = sha1sum
+    if sha256sum:
+        hashes["SHA256"] = sha256sum
+    if md5sum:
+        hashes["MD5"] = md5sum
+
     # Do we download the file? Force by default
     download = force
 
@@ -87,24 +204,50 @@ def download(
             if info["mtime"] and info["mtime"] > cache_time:
                 download = True
 
-        if sha1sum:
-            if sha1sum != host.get_fact(Sha1File, path=dest):
-                download = True
-
-        if sha256sum:
-            if sha256sum != host.get_fact(Sha256File, path=dest):
-                download = True
-
-        if md5sum:
-            if md5sum != host.get_fact(Md5File, path=dest):
-                download = True
+        # Hash the existing file once for every requested algorithm
+        if hashes:
+            existing_hashes = host.get_fact(
+                FileHashes,
+                path=dest,
+                algorithms=list(hashes.keys()),
+            )
+            for name, value in hashes.items():
+                if value.lower() != (existing_hashes or {}).get(name, "").lower():
+                    download = True
 
     # If we download, always do user/group/mode as SSH user may be different
     if download:
-        yield (
-            '$ProgressPreference = "SilentlyContinue"; '
-            "Invoke-WebRequest -Uri {0} -OutFile {1}"
-        ).format(src, dest)
+        if fetch_locally:
+            download_commands = [
+                FunctionCommand(
+                    _fetch_and_upload,
+                    (src, dest, hashes, upload_concurrency),
+                    {},
+                ),
+            ]
+        else:
+            download_commands = [
+                make_download_command(
+                    src,
+                    dest,
+                    hashes=hashes,
+                    segments=segments,
+                    retries=retries,
+                ),
+            ]
+
+        if cache:
+            yield from _cached_transfer(
+                sha256sum,
+                dest,
+                cache_dir,
+                cache_max_size,
+                download_commands,
+                # The download checks the hashes while streaming
+                verified=not fetch_locally,
+            )
+        else:
+            yield from download_commands
 
         # if user or group:
         #    yield chown(dest, user, group)
@@ -112,27 +255,6 @@ def download(
         # if mode:
         #    yield chmod(dest, mode)
 
-        if sha1sum:
-            yield (
-                'if ((Get-FileHash -Algorithm SHA1 "{0}").hash -ne {1}) {{ '
-                'Write-Error "SHA1 did not match!" '
-                "}}"
-            ).format(dest, sha1sum)
-
-        if sha256sum:
-            yield (
-                'if ((Get-FileHash -Algorithm SHA256 "{0}").hash -ne {1}) {{ '
-                'Write-Error "SHA256 did not match!" '
-                "}}"
-            ).format(dest, sha256sum)
-
-        if md5sum:
-            yield (
-                'if ((Get-FileHash -Algorithm MD5 "{0}").hash -ne {1}) {{ '
-                'Write-Error "MD5 did not match!" '
-                "}}"
-            ).format(dest, md5sum)
-
     else:
         host.noop("file {0} has already been downloaded".format(dest))
 
@@ -148,6 +270,9 @@ def put(
     create_remote_dir=True,
     force=False,
     assume_exists=False,
+    cache=False,
+    cache_dir=None,
+    cache_max_size=None,
 ):
     """
     Upload a local file to the remote system.
@@ -161,12 +286,18 @@ def put(
     + create_remote_dir: create the remote directory if it doesn't exist
     + force: always upload the file, even if the remote copy matches
     + assume_exists: whether to assume the local file exists
+    + cache: satisfy the upload from the artifact cache on the host
+    + cache_dir: directory of the artifact cache, defaults to ``pyinfra-artifacts`` in the temp dir
+    + cache_max_size: size in bytes to trim the artifact cache to after adding a file
 
     ``create_remote_dir``:
         If the remote directory does not exist it will be created using the same
         user & group as passed to ``files.put``. The mode will *not* be copied over,
         if this is required call ``files.directory`` separately.
 
+    ``cache``:
+        See ``files.download``, files are stored by the sha256 of the local file.
+
     Note:
         This operation is not suitable for large files as it may involve copying
         the file before uploading it.
@@ -204,13 +335,26 @@ def put(
     if create_remote_dir:
         yield from _create_remote_dir(state, host, dest, user, group)
 
-    # No remote file, always upload and user/group/mode if supplied
-    if not remote_file or force:
-        yield FileUploadCommand(
+    def upload_commands():
+        upload_command = FileUploadCommand(
             local_file,
             dest,
             remote_temp_filename=state.get_temp_filename(dest),
         )
+        if cache:
+            yield from _cached_transfer(
+                get_file_sha256(local_file),
+                dest,
+                cache_dir,
+                cache_max_size,
+                [upload_command],
+            )
+        else:
+            yield upload_command
+
+    # No remote file, always upload and user/group/mode if supplied
+    if not remote_file or force:
+        yield from upload_commands()
 
         # if user or group:
         #    yield chown(dest, user, group)
@@ -225,11 +369,7 @@ def put(
 
         # Check sha1sum, upload if needed
         if local_sum != remote_sum:
-            yield FileUploadCommand(
-                local_file,
-                dest,
-                remote_temp_filename=state.get_temp_filename(dest),
-            )
+            yield from upload_commands()
 
             # if user or group:
             #    yield chown(dest, user, group)
@@ -257,6 +397,27 @@ def put(
                 host.noop("file {0} is already uploaded".format(dest))
 
 
+@operation(is_idempotent=False)
+def clean_artifact_cache(max_size=0, cache_dir=None):
+    """
+    Remove the least recently used files from the artifact cache.
+
+    + max_size: size in bytes to trim the cache to, ``0`` empties it
+    + cache_dir: directory of the artifact cache, defaults to ``pyinfra-artifacts`` in the temp dir
+
+    **Example:**
+
+    .. code:: python
+
+        files.clean_artifact_cache(
+            name="Keep at most 10GB of cached artifacts",
+            max_size=10 * 1024 * 1024 * 1024,
+        )
+    """
+
+    yield make_cache_trim_command(_get_artifact_cache_dir(cache_dir), max_size)
+
+
 @operation()
 def file(
     path,
@@ -534,3 +695,118 @@ def link(
         yield remove_cmd
     else:
         host.noop("link {0} already exists and force=False".format(path))
+
+
+@operation()
+def line(
+    path,
+    line,
+    present=True,
+    replace=None,
+    flags=None,
+    backup=False,
+    escape_regex_characters=False,
+):
+    """
+    Ensure lines in files using .NET regex matching, editing the file on the target.
+
+    + path: target remote file to edit
+    + line: string or regex matching the target line
+    + present: whether the line should be in the file
+    + replace: text to replace entire matching lines with
+    + flags: list of flags, ``i`` to match case insensitively
+    + backup: whether to keep a backup of the file (``<path>.<timestamp>``) when it
+      changes
+    + escape_regex_characters: whether to escape regex characters from the matching line
+
+    Regex line matching:
+        Unless line matches a line (starts with ^, ends $), pyinfra will wrap it such
+        that it does, like: ``^.*LINE.*$``. This means we don't swap parts of lines
+        out. To change bits of lines, see ``files.replace``.
+
+    Streaming edits:
+        The file is never transferred: a single script reads it line by line on the
+        target, writes the result to a temporary file next to it and replaces the
+        file only if a line changed. The encoding and line endings of the file are
+        kept. As the match check happens in the same script, the operation always
+        runs it and reports whether the file changed in its output.
+
+    Appending:
+        If ``present`` and no line matches, ``replace`` (or ``line``) is appended to
+        the file, creating it if it doesn't exist.
+
+    **Examples:**
+
+    .. code:: python
+
+        files.line(
+            name="Ensure the app listens on port 8080",
+            path=r"C:\\app\\app.ini",
+            line=r"^Port=",
+            replace="Port=8080",
+        )
+
+        files.line(
+            name="Remove the debug setting",
+            path=r"C:\\app\\app.ini",
+            line="Debug=",
+            present=False,
+        )
+    """
+
+    _validate_path(path)
+
+    yield make_line_command(
+        path,
+        adjust_regex(line, escape_regex_characters),
+        replace if replace is not None else line,
+        present=present,
+        replace=replace,
+        flags=flags,
+        backup=backup,
+    )
+
+
+@operation()
+def replace(
+    path,
+    text=None,
+    replace=None,
+    flags=None,
+    backup=False,
+):
+    """
+    Replace contents of a file using .NET regex matching, editing the file on the
+    target.
+
+    + path: target remote file to edit
+    + text: text/regex to match against
+    + replace: text to replace with, ``$1`` etc refer to groups in ``text``
+    + flags: list of flags, ``i`` to match case insensitively and ``g`` to replace
+      every match in a line rather than the first
+    + backup: whether to keep a backup of the file (``<path>.<timestamp>``) when it
+      changes
+
+    Like ``files.line`` the file is edited by a single script streaming it on the
+    target, and only replaced if a line changed.
+
+    **Example:**
+
+    .. code:: python
+
+        files.replace(
+            name="Point the app at the new database server",
+            path=r"C:\\app\\app.ini",
+            text="Server=db01",
+            replace="Server=db02",
+        )
+    """
+
+    _validate_path(path)
+
+    if text is None:
+        raise OperationValueError("Must provide `text`")
+    if replace is None:
+        raise OperationValueError("Must provide `replace`")
+
+    yield make_replace_command(path, text, replace, flags=flags, backup=backup)
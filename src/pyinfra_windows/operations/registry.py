@@ -0,0 +1,166 @@
+"""
+Manage Windows registry values.
+"""
+
+from __future__ import annotations
+
+from pyinfra import host
+from pyinfra.api import OperationValueError, operation
+
+from pyinfra_windows.connectors.util import quote_ps_string
+from pyinfra_windows.facts.registry import RegistryValues
+
+REGISTRY_TYPES = ("String", "ExpandString", "Binary", "DWord", "QWord", "MultiString")
+
+
+def _get_desired_value(key, name, value):
+    """
+    Returns the ``(type, value)`` for a desired value, ``value`` being either a plain
+    value or a ``(value, type)`` tuple.
+    """
+
+    if isinstance(value, tuple):
+        value, value_type = value
+        if value_type not in REGISTRY_TYPES:
+            raise OperationValueError(
+                "Invalid registry type for {0}\\{1}: {2}".format(key, name, value_type),
+            )
+    elif isinstance(value, bool) or not isinstance(value, (int, str, bytes, list)):
+        raise OperationValueError(
+            "Invalid registry value for {0}\\{1}: {2!r}".format(key, name, value),
+        )
+    elif isinstance(value, int):
+        value_type = "DWord" if 0 <= value <= 0xFFFFFFFF else "QWord"
+    elif isinstance(value, bytes):
+        value_type = "Binary"
+    elif isinstance(value, list):
+        value_type = "MultiString"
+    else:
+        value_type = "String"
+
+    return value_type, _normalize_value(value_type, value)
+
+
+def _normalize_value(value_type, value):
+    # DWord/QWord values are read back as signed integers
+    if value_type == "DWord":
+        return int(value) & 0xFFFFFFFF
+    if value_type == "QWord":
+        return int(value) & 0xFFFFFFFFFFFFFFFF
+    if value_type == "Binary":
+        return list(value)
+    if value_type == "MultiString":
+        if isinstance(value, str):
+            value = [value]
+        return [str(item) for item in value]
+    return str(value)
+
+
+def _format_value(value_type, value):
+    if value_type in ("DWord", "QWord"):
+        # New-ItemProperty wants the signed value for the high bit
+        bits = 32 if value_type == "DWord" else 64
+        if value >= 1 << (bits - 1):
+            value -= 1 << bits
+        return str(value)
+    if value_type == "Binary":
+        return "([byte[]]@({0}))".format(", ".join(str(item) for item in value))
+    if value_type == "MultiString":
+        return "([string[]]@({0}))".format(
+            ", ".join(quote_ps_string(item) for item in value),
+        )
+    return quote_ps_string(value)
+
+
+@operation()
+def values(values: dict[str, dict], present=True):
+    """
+    Set/remove many registry values with a single script.
+
+    + values: dict of registry key path to a dict of value name to value
+    + present: whether the values should exist, ``False`` removes them
+
+    Types:
+        Value types are picked from the Python type: ``int`` as ``DWord`` (or
+        ``QWord`` when it doesn't fit in 32 bits), ``str`` as ``String``, ``bytes`` as
+        ``Binary`` and ``list`` as ``MultiString``. Pass a ``(value, type)`` tuple to
+        set the type explicitly, e.g. ``("%SystemRoot%\\Temp", "ExpandString")``.
+
+    Batching:
+        All values are read with one ``RegistryValues`` fact and all the values that
+        differ are set (or removed) by one generated script, creating missing keys.
+        The script stops at the first failure. Scripts for large batches (a couple
+        of hundred values) are too long for a command line and are sent on the
+        standard input of PowerShell instead.
+
+    **Example:**
+
+    .. code:: python
+
+        registry.values(
+            name="Disable automatic updates and SMBv1",
+            values={
+                "HKLM:\\SOFTWARE\\Policies\\Microsoft\\Windows\\WindowsUpdate\\AU": {
+                    "NoAutoUpdate": 1,
+                },
+                "HKLM:\\SYSTEM\\CurrentControlSet\\Services\\LanmanServer\\Parameters": {
+                    "SMB1": 0,
+                },
+            },
+        )
+    """
+
+    current_values = host.get_fact(
+        RegistryValues,
+        keys={key: list(key_values) for key, key_values in values.items()},
+    )
+
+    commands = []
+    for key, key_values in values.items():
+        current_key_values = current_values.get(key)
+        quoted_key = quote_ps_string(key)
+
+        if not present:
+            if current_key_values is None:
+                continue
+            for name in key_values:
+                if current_key_values.get(name) is not None:
+                    commands.append(
+                        "Remove-ItemProperty -LiteralPath {0} -Name {1}".format(
+                            quoted_key,
+                            quote_ps_string(name),
+                        ),
+                    )
+            continue
+
+        if current_key_values is None:
+            commands.append("New-Item -Path {0} -Force | Out-Null".format(quoted_key))
+            current_key_values = {}
+
+        for name, value in key_values.items():
+            value_type, value = _get_desired_value(key, name, value)
+
+            current = current_key_values.get(name)
+            if (
+                current is not None
+                and current["Type"] == value_type
+                and _normalize_value(value_type, current["Value"]) == value
+            ):
+                continue
+
+            commands.append(
+                "New-ItemProperty -LiteralPath {0} -Name {1} -PropertyType {2} "
+                "-Value {3} -Force | Out-Null".format(
+                    quoted_key,
+                    quote_ps_string(name),
+                    value_type,
+                    _format_value(value_type, value),
+                ),
+            )
+
+    if commands:
+        yield "\n".join(["$ErrorActionPreference = 'Stop'"] + commands)
+    else:
+        host.noop(
+            "registry values already {0}".format("set" if present else "removed"),
+        )
@@ -2,7 +2,23 @@
 The windows module handles misc windows operations.
 """
 
-from pyinfra.api import operation
+from __future__ import annotations
+
+from time import sleep, time
+
+from requests import RequestException
+from winrm.exceptions import WinRMError, WinRMOperationTimeoutError, WinRMTransportError
+
+from pyinfra import host, logger
+from pyinfra.api import (
+    FunctionCommand,
+    OperationError,
+    OperationValueError,
+    operation,
+)
+
+from pyinfra_windows.connectors.util import quote_ps_string
+from pyinfra_windows.facts.server import LastReboot, ServiceStates
 
 # Tip: Use 'Get-Command -Noun Service' to search for what commands are available or
 # simply 'Get-Command' to see what you can do...)
@@ -17,17 +33,35 @@ from pyinfra.api import operation
 # FUTURE: add ability to stop processes (ex: "Stop-Process <id>")
 
 
-@operation(is_idempotent=False)
-def service(service, running=True, restart=False, suspend=False):
+# Win32_Service StartMode -> Set-Service StartupType
+START_MODE_TO_START_TYPE = {
+    "Auto": "Automatic",
+    "Manual": "Manual",
+    "Disabled": "Disabled",
+}
+
+
+@operation()
+def service(
+    service: str | list[str],
+    running=True,
+    restart=False,
+    suspend=False,
+    start_type: str | None = None,
+):
     """
     Stop/Start a Windows service.
 
-    + service: name of the service to manage
+    + service: name (or list of names) of the service(s) to manage
     + running: whether the the service should be running or stopped
     + restart: whether the the service should be restarted
     + suspend: whether the the service should be suspended
+    + start_type: startup type of the service, one of ``Automatic``, ``Manual`` or ``Disabled``
 
-    **Example:**
+    Services already in the desired state are left alone. All required changes for
+    all given services are made with a single command.
+
+    **Examples:**
 
     .. code:: python
 
@@ -36,24 +70,154 @@ def service(service, running=True, restart=False, suspend=False):
             service="service",
             running=False,
         )
+
+        windows.service(
+            name="Ensure the web services are running and start on boot",
+            service=["W3SVC", "WAS"],
+            start_type="Automatic",
+        )
     """
 
-    if suspend or not running:
+    if isinstance(service, str):
+        service = [service]
+
+    if start_type is not None and start_type not in START_MODE_TO_START_TYPE.values():
+        raise OperationValueError("Invalid start_type: {0}".format(start_type))
+
+    current_services = host.get_fact(ServiceStates, services=service)
+
+    commands = []
+    for name in service:
+        info = current_services.get(name)
+        if info is None:
+            raise OperationError("Service {0} does not exist".format(name))
+
+        quoted_name = quote_ps_string(name)
+        state = info.get("State")
+
+        # Set the startup type first, so a previously disabled service can be started
+        current_start_type = START_MODE_TO_START_TYPE.get(info.get("StartMode"))
+        if start_type is not None and current_start_type != start_type:
+            commands.append(
+                "Set-Service -Name {0} -StartupType {1}".format(
+                    quoted_name, start_type
+                ),
+            )
+
         if suspend:
-            yield "Suspend-Service -Name {0}".format(service)
-        else:
-            yield "Stop-Service -Name {0}".format(service)
+            if state != "Paused":
+                commands.append("Suspend-Service -Name {0}".format(quoted_name))
+        elif not running:
+            if state != "Stopped":
+                commands.append("Stop-Service -Name {0}".format(quoted_name))
+        elif restart:
+            commands.append("Restart-Service -Name {0}".format(quoted_name))
+        elif state == "Paused":
+            commands.append("Resume-Service -Name {0}".format(quoted_name))
+        elif state != "Running":
+            commands.append("Start-Service -Name {0}".format(quoted_name))
+
+    if commands:
+        # Stop at the first failure rather than carrying on with the other services
+        yield "$ErrorActionPreference = 'Stop'; {0}".format("; ".join(commands))
     else:
-        if restart:
-            yield "Restart-Service -Name {0}".format(service)
-        else:
-            if running:
-                yield "Start-Service -Name {0}".format(service)
+        host.noop(
+            "service{0} {1} already in the desired state".format(
+                "s" if len(service) > 1 else "",
+                ", ".join(service),
+            ),
+        )
+
+
+def _get_last_reboot(host):
+    """
+    Reconnects to the host and returns its last reboot time, or ``None`` if it can't
+    be reached.
+    """
+
+    host.disconnect()
+    host.connect(show_errors=False)
+    if not host.connected:
+        return None
+
+    try:
+        status, output = host.run_shell_command(LastReboot.command)
+    except (
+        RequestException,
+        WinRMError,
+        WinRMOperationTimeoutError,
+        WinRMTransportError,
+    ) as e:
+        logger.debug("Host not reachable: %s", e)
+        return None
+
+    if not status:
+        return None
+    return LastReboot.process(output.stdout_lines)
 
 
 @operation(is_idempotent=False)
-def reboot():
+def reboot(wait=True, interval=1, max_interval=30, reboot_timeout=600):
     """
-    Restart the server.
+    Restart the server and wait for reconnection.
+
+    + wait: whether to wait for the server to come back before continuing
+    + interval: initial interval (s) between reconnect attempts, doubled after each attempt
+    + max_interval: maximum interval (s) between reconnect attempts
+    + reboot_timeout: total time (s) before giving up reconnecting
+
+    The reboot is confirmed once the ``LastReboot`` fact changes, so the deploy
+    continues as soon as the server is back rather than after a fixed delay.
+
+    **Example:**
+
+    .. code:: python
+
+        windows.reboot(
+            name="Reboot the server and wait to reconnect",
+            reboot_timeout=900,
+        )
     """
+
+    if not wait:
+        yield "Restart-Computer -Force"
+        return
+
+    pre_reboot_last_reboot: list[str] = []
+
+    def capture_last_reboot(state, host):
+        pre_reboot_last_reboot.append(host.get_fact(LastReboot))
+
+    yield FunctionCommand(capture_last_reboot, (), {})
+
     yield "Restart-Computer -Force"
+
+    def wait_and_reconnect(state, host):
+        deadline = time() + reboot_timeout
+        wait_interval = interval
+
+        while True:
+            # Until the server has shut down this still returns the old value
+            last_reboot = _get_last_reboot(host)
+            logger.debug(
+                "Reconnect attempt (last_reboot=%s, pre_reboot_last_reboot=%s)",
+                last_reboot,
+                pre_reboot_last_reboot[0],
+            )
+            if last_reboot and last_reboot != pre_reboot_last_reboot[0]:
+                logger.debug("Reboot confirmed.")
+                return True
+
+            if time() + wait_interval > deadline:
+                logger.error(
+                    "{0}Server did not reboot after {1} seconds".format(
+                        host.print_prefix,
+                        reboot_timeout,
+                    ),
+                )
+                return False
+
+            sleep(wait_interval)
+            wait_interval = min(wait_interval * 2, max_interval)
+
+    yield FunctionCommand(wait_and_reconnect, (), {})
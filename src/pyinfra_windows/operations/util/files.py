@@ -1,9 +1,18 @@
 from __future__ import annotations
 
+import hashlib
+import ntpath
+import os
 import re
 from datetime import datetime
+from urllib.request import urlopen
 
-from pyinfra.api import QuoteString, StringCommand
+from gevent.lock import BoundedSemaphore, Semaphore
+
+from pyinfra.api import OperationError
+from pyinfra.api.util import sha1_hash
+
+from pyinfra_windows.connectors.util import quote_ps_string
 
 
 def ensure_mode_int(mode: str | int | None) -> int | str | None:
@@ -26,105 +35,427 @@ def get_timestamp() -> str:
     return datetime.now().strftime("%y%m%d%H%M")
 
 
-def sed_replace(
-    filename: str,
+def adjust_regex(line: str, escape_regex_characters: bool) -> str:
+    """
+    Ensure the regex starts with '^' and ends with '$' and escape regex characters if requested
+    """
+    match_line = line
+
+    if escape_regex_characters:
+        match_line = re.sub(r"([\.\\\+\*\?\[\^\]\$\(\)\{\}\-])", r"\\\1", match_line)
+
+    # Ensure we're matching a whole line, note: match may be a partial line so we
+    # put any matches on either side.
+    if not match_line.startswith("^"):
+        match_line = "^.*{0}".format(match_line)
+    if not match_line.endswith("$"):
+        match_line = "{0}.*$".format(match_line)
+
+    return match_line
+
+
+# Edits ``$path`` line by line into a temporary file next to it, which then replaces
+# the file (keeping its ACLs) only if a line changed. The encoding and line endings
+# of the file are kept: a BOM picks the encoding it marks and is written back, files
+# without one are UTF-8 (written without a BOM) if their start decodes as such and
+# otherwise in the ANSI code page so their bytes round trip. Each line is in
+# ``$text`` for ``{edit_line}``, which sets ``$changed`` (and ``continue``s to drop
+# the line). A failed edit removes the temporary file and leaves the file as it was.
+STREAM_EDIT_SCRIPT = """$ErrorActionPreference = 'Stop'
+$path = {path}
+{missing_file}$path = (Get-Item -LiteralPath $path).FullName
+$regex = New-Object Text.RegularExpressions.Regex({pattern}, {options})
+$temp = '{{0}}.{{1}}.tmp' -f $path, [IO.Path]::GetRandomFileName()
+$stream = [IO.File]::OpenRead($path)
+$head = New-Object byte[] 64KB
+$read = $stream.Read($head, 0, $head.Length)
+$stream.Dispose()
+$unit = 1
+if ($read -ge 3 -and $head[0] -eq 0xEF -and $head[1] -eq 0xBB -and $head[2] -eq 0xBF) {{
+    $encoding = New-Object Text.UTF8Encoding($true, $true)
+}} elseif ($read -ge 4 -and $head[0] -eq 0xFF -and $head[1] -eq 0xFE -and $head[2] -eq 0 -and $head[3] -eq 0) {{
+    $encoding = New-Object Text.UTF32Encoding($false, $true, $true); $unit = 4
+}} elseif ($read -ge 4 -and $head[0] -eq 0 -and $head[1] -eq 0 -and $head[2] -eq 0xFE -and $head[3] -eq 0xFF) {{
+    $encoding = New-Object Text.UTF32Encoding($true, $true, $true); $unit = 4
+}} elseif ($read -ge 2 -and $head[0] -eq 0xFF -and $head[1] -eq 0xFE) {{
+    $encoding = New-Object Text.UnicodeEncoding($false, $true, $true); $unit = 2
+}} elseif ($read -ge 2 -and $head[0] -eq 0xFE -and $head[1] -eq 0xFF) {{
+    $encoding = New-Object Text.UnicodeEncoding($true, $true, $true); $unit = 2
+}} else {{
+    $encoding = New-Object Text.UTF8Encoding($false, $true)
+    try {{ [void]$encoding.GetDecoder().GetCharCount($head, 0, $read, $false) }} catch {{
+        $encoding = [Text.Encoding]::GetEncoding([Globalization.CultureInfo]::CurrentCulture.TextInfo.ANSICodePage)
+    }}
+}}
+$lf = [Array]::IndexOf($head, [byte]10, 0, $read)
+$changed = $false
+$found = $false
+$reader = New-Object IO.StreamReader($path, $encoding, $true)
+try {{
+    $writer = New-Object IO.StreamWriter($temp, $false, $encoding)
+    if ($lf -ge 0 -and ($lf -lt $unit -or $head[$lf - $unit] -ne 13)) {{ $writer.NewLine = "`n" }}
+    try {{
+        while ($null -ne ($text = $reader.ReadLine())) {{
+{edit_line}
+            $writer.WriteLine($text)
+        }}
+{finish}    }} finally {{ $writer.Dispose() }}
+}} catch {{
+    Remove-Item -LiteralPath $temp -ErrorAction SilentlyContinue
+    throw
+}} finally {{ $reader.Dispose() }}
+if ($changed) {{ [IO.File]::Replace($temp, $path, {backup}); "$path changed" }} else {{
+    Remove-Item -LiteralPath $temp; "$path unchanged"
+}}"""
+
+
+def _make_stream_edit_command(
+    path: str,
+    pattern: str,
+    flags: list[str] | None,
+    edit_line: str,
+    finish: str = "",
+    missing_file: str = "",
+    backup=False,
+) -> str:
+    # $null would be passed to .NET as an empty string, not a null backup path
+    backup_path = "[NullString]::Value"
+    if backup:
+        backup_path = "'{{0}}.{0}' -f $path".format(get_timestamp())
+
+    return STREAM_EDIT_SCRIPT.format(
+        path=quote_ps_string(path),
+        missing_file=missing_file,
+        pattern=quote_ps_string(pattern),
+        options="'IgnoreCase'" if flags and "i" in flags else "'None'",
+        edit_line=edit_line,
+        finish=finish,
+        backup="({0})".format(backup_path) if backup else backup_path,
+    )
+
+
+def make_line_command(
+    path: str,
+    match_line: str,
     line: str,
+    present=True,
+    replace: str | None = None,
+    flags: list[str] | None = None,
+    backup=False,
+) -> str:
+    """
+    Builds a PowerShell script that ensures lines matching ``match_line`` are
+    present (appending ``line`` if none match, replacing matching lines with
+    ``replace`` if set) or removed, checking for matches on the target.
+    """
+
+    if not present:
+        return _make_stream_edit_command(
+            path,
+            match_line,
+            flags,
+            edit_line="            if ($regex.IsMatch($text)) { $changed = $true; continue }",
+            missing_file="if (-not (Test-Path -LiteralPath $path -PathType Leaf)) "
+            '{ "$path unchanged"; return }\n',
+            backup=backup,
+        )
+
+    edit_line = "            if ($regex.IsMatch($text)) { $found = $true }"
+    if replace is not None:
+        edit_line = (
+            "            if ($regex.IsMatch($text)) {{ $found = $true\n"
+            "                if ($text -cne {0}) {{ $text = {0}; $changed = $true }}\n"
+            "            }}"
+        ).format(quote_ps_string(replace))
+
+    return _make_stream_edit_command(
+        path,
+        match_line,
+        flags,
+        edit_line=edit_line,
+        finish="        if (-not $found) {{ $writer.WriteLine({0}); $changed = $true }}\n".format(
+            quote_ps_string(line),
+        ),
+        missing_file=(
+            "if (-not (Test-Path -LiteralPath $path -PathType Leaf)) {{\n"
+            '    [IO.File]::WriteAllText($path, {0} + "`r`n"); "$path changed"; return\n'
+            "}}\n"
+        ).format(quote_ps_string(line)),
+        backup=backup,
+    )
+
+
+def make_replace_command(
+    path: str,
+    text: str,
     replace: str,
     flags: list[str] | None = None,
     backup=False,
-    interpolate_variables=False,
-) -> StringCommand:
-    flags_str = "".join(flags) if flags else ""
-
-    line = line.replace("/", r"\/")
-    replace = str(replace)
-    replace = replace.replace("/", r"\/")
-    replace = replace.replace("&", r"\&")
-    backup_extension = get_timestamp()
-
-    if interpolate_variables:
-        line = line.replace('"', '\\"')
-        replace = replace.replace('"', '\\"')
-        sed_script_formatter = '"s/{0}/{1}/{2}"'
-    else:
-        # Single quotes cannot contain other single quotes, even when escaped , so turn
-        # each ' into '"'"' (end string, double quote the single quote, (re)start string)
-        line = line.replace("'", "'\"'\"'")
-        replace = replace.replace("'", "'\"'\"'")
-        sed_script_formatter = "'s/{0}/{1}/{2}'"
-
-    sed_script = sed_script_formatter.format(line, replace, flags_str)
-
-    sed_command = StringCommand(
-        "sed",
-        "-i.{0}".format(backup_extension),
-        sed_script,
-        QuoteString(filename),
+) -> str:
+    """
+    Builds a PowerShell script replacing the first (or with the ``g`` flag every)
+    match of ``text`` in each line of a file with ``replace``.
+    """
+
+    return _make_stream_edit_command(
+        path,
+        text,
+        flags,
+        edit_line=(
+            "            $new = $regex.Replace($text, {0}{1})\n"
+            "            if ($new -cne $text) {{ $text = $new; $changed = $true }}"
+        ).format(quote_ps_string(replace), "" if flags and "g" in flags else ", 1"),
+        backup=backup,
     )
 
-    if not backup:  # if we're not backing up, remove the file *if* sed succeeds
-        backup_filename = "{0}.{1}".format(filename, backup_extension)
-        sed_command = StringCommand(
-            sed_command, "&&", "rm", "-f", QuoteString(backup_filename)
-        )
 
-    return sed_command
+# Streams ``$src`` into ``$part`` with ``HttpClient`` and only moves it over ``$dest``
+# once complete. Interrupted transfers are retried with a ``Range`` request from
+# the current offset, and a leftover ``$part`` from a previous run is resumed the
+# same way. With ``$segments`` > 1 large files are fetched as parallel ranges into
+# ``$part.<n>`` and joined. Every requested hash is fed while the data is written,
+# so the file is never read back just to verify it.
+# Note: this is kept terse as the encoded command must fit the cmd line limit.
+DOWNLOAD_SCRIPT = """$ErrorActionPreference='Stop'
+$ProgressPreference='SilentlyContinue'
+Add-Type -AssemblyName System.Net.Http
+$spm=[Net.ServicePointManager]
+$spm::SecurityProtocol=$spm::SecurityProtocol -bor 'Tls12'
+$spm::DefaultConnectionLimit=[Math]::Max($segments,2)
+$c=New-Object Net.Http.HttpClient
+$c.Timeout=[Threading.Timeout]::InfiniteTimeSpan
+$buf=New-Object byte[] 1MB
+$h=@{}
+function Reset-Hash{foreach($k in $hashes.Keys){$h[$k]=[Security.Cryptography.HashAlgorithm]::Create($k)}}
+function Open-Url($from,$to){$r=New-Object Net.Http.HttpRequestMessage([Net.Http.HttpMethod]::Get,$src)
+if($from -or $to -ne $null){$r.Headers.Range=New-Object Net.Http.Headers.RangeHeaderValue($from,$to)}
+$c.SendAsync($r,'ResponseHeadersRead').Result}
+function Copy-Data($i,$o){try{while(($n=$i.Read($buf,0,$buf.Length)) -gt 0){if($o){$o.Write($buf,0,$n)}
+foreach($a in $h.Values){[void]$a.TransformBlock($buf,0,$n,$null,0)}}}finally{$i.Dispose()}}
+function Receive-Single{Reset-Hash;$len=0
+if(Test-Path -LiteralPath $part){$len=(Get-Item -LiteralPath $part).Length;Copy-Data ([IO.File]::OpenRead($part)) $null}
+for($t=0;;$t++){try{$r=Open-Url $len $null
+if($r.StatusCode -eq 416){$r.Dispose();break}
+[void]$r.EnsureSuccessStatusCode();$m='Append'
+if($len -and $r.StatusCode -ne 206){Reset-Hash;$m='Create'}
+$f=[IO.File]::Open($part,$m)
+try{Copy-Data ($r.Content.ReadAsStreamAsync().Result) $f}finally{$len=$f.Length;$f.Dispose();$r.Dispose()}
+break}catch{if($t -ge $retries){throw};Start-Sleep ([Math]::Pow(2,$t))}}}
+function Receive-Segments{$r=Open-Url 0 0;$total=$r.Content.Headers.ContentRange.Length;$ok=$r.StatusCode -eq 206;$r.Dispose()
+if(-not $ok -or $total -lt $segments*8MB){return $false}
+$size=[long][Math]::Ceiling($total/$segments)
+for($t=0;;$t++){$open=@();$tasks=@()
+try{for($i=0;$i -lt $segments;$i++){$p="$part.$i";$from=$i*$size;$to=[Math]::Min($total,$from+$size)-1;$have=0
+if(Test-Path -LiteralPath $p){$have=(Get-Item -LiteralPath $p).Length}
+if($from+$have -le $to){$r=Open-Url ($from+$have) $to;[void]$r.EnsureSuccessStatusCode()
+$f=[IO.File]::Open($p,'Append');$open+=$r,$f;$tasks+=$r.Content.ReadAsStreamAsync().Result.CopyToAsync($f,1MB)}}
+[Threading.Tasks.Task]::WaitAll([Threading.Tasks.Task[]]$tasks);break
+}catch{if($t -ge $retries){throw};Start-Sleep ([Math]::Pow(2,$t))}finally{$open|%{$_.Dispose()}}}
+Reset-Hash;$f=[IO.File]::Create($part)
+try{for($i=0;$i -lt $segments;$i++){Copy-Data ([IO.File]::OpenRead("$part.$i")) $f}}finally{$f.Dispose()}
+for($i=0;$i -lt $segments;$i++){Remove-Item -LiteralPath "$part.$i"}
+$true}
+if($segments -le 1 -or -not (Receive-Segments)){Receive-Single}
+foreach($k in $hashes.Keys){[void]$h[$k].TransformFinalBlock($buf,0,0)
+if([BitConverter]::ToString($h[$k].Hash).Replace('-','') -ne $hashes[$k]){Remove-Item -LiteralPath $part;throw "$k did not match!"}}
+Move-Item -LiteralPath $part -Destination $dest -Force"""
+
+
+def make_download_command(
+    src: str,
+    dest: str,
+    hashes: dict[str, str] | None = None,
+    segments: int = 1,
+    retries: int = 3,
+) -> str:
+    """
+    Builds a PowerShell script that downloads ``src`` to ``dest`` with resume support,
+    verifying ``hashes`` (algorithm name -> expected hex digest) while streaming.
+    """
 
+    hashes_str = "; ".join(
+        "{0} = {1}".format(quote_ps_string(name), quote_ps_string(value))
+        for name, value in (hashes or {}).items()
+    )
 
-def chmod(target: str, mode: str | int, recursive=False) -> StringCommand:
-    args = ["chmod"]
-    if recursive:
-        args.append("-R")
+    # The partial file is keyed on the source, so a stale partial download of a
+    # different URL is never resumed into this one.
+    part = "{0}.{1}.part".format(dest, sha1_hash(src)[:8])
+
+    return "$src={0}; $dest={1}; $part={2}; $hashes=@{{{3}}}; $segments={4}; $retries={5}\n{6}".format(
+        quote_ps_string(src),
+        quote_ps_string(dest),
+        quote_ps_string(part),
+        hashes_str,
+        int(segments),
+        int(retries),
+        DOWNLOAD_SCRIPT,
+    )
 
-    args.append("{0}".format(mode))
 
-    return StringCommand(" ".join(args), QuoteString(target))
+def make_cache_restore_command(cached_file: str, dest: str) -> str:
+    """
+    Copies a file out of the artifact cache, marking it as recently used.
+    """
 
+    return (
+        "(Get-Item -LiteralPath {0}).LastAccessTime = Get-Date; "
+        "Copy-Item -LiteralPath {0} -Destination {1} -Force"
+    ).format(quote_ps_string(cached_file), quote_ps_string(dest))
 
-def chown(
-    target: str,
-    user: str | None = None,
-    group: str | None = None,
-    recursive=False,
-    dereference=True,
-) -> StringCommand:
-    command = "chown"
-    user_group = None
 
-    if user and group:
-        user_group = "{0}:{1}".format(user, group)
+def make_cache_store_command(
+    cached_file: str,
+    src: str,
+    sha256: str | None = None,
+) -> str:
+    """
+    Copies a file into the artifact cache, via a temporary file so a partial copy
+    is never picked up as a cached artifact. With ``sha256``, fails, storing
+    nothing, if the file doesn't match it.
+    """
 
-    elif user:
-        user_group = user
+    command = (
+        "New-Item -ItemType Directory -Force -Path {0} | Out-Null; "
+        "Copy-Item -LiteralPath {1} -Destination {2} -Force; "
+        "Move-Item -LiteralPath {2} -Destination {3} -Force; "
+        "(Get-Item -LiteralPath {3}).LastAccessTime = Get-Date"
+    ).format(
+        quote_ps_string(ntpath.dirname(cached_file)),
+        quote_ps_string(src),
+        quote_ps_string("{0}.tmp".format(cached_file)),
+        quote_ps_string(cached_file),
+    )
 
-    elif group:
-        command = "chgrp"
-        user_group = group
+    if sha256:
+        command = (
+            "if ((Get-FileHash -LiteralPath {0} -Algorithm SHA256).Hash -ne {1}) {{ "
+            "throw 'File to cache did not match its SHA256!' }}; {2}"
+        ).format(quote_ps_string(src), quote_ps_string(sha256.upper()), command)
+    return command
 
-    args = [command]
-    if recursive:
-        args.append("-R")
 
-    if not dereference:
-        args.append("-h")
+def make_cache_trim_command(cache_dir: str, max_size: int) -> str:
+    """
+    Removes the least recently used artifacts until the cache fits in ``max_size`` bytes.
+    """
 
-    return StringCommand(" ".join(args), user_group, QuoteString(target))
+    return (
+        "if (Test-Path -LiteralPath {0}) {{ $total = 0; "
+        "Get-ChildItem -LiteralPath {0} -File | Sort-Object LastAccessTime -Descending | "
+        "ForEach-Object {{ $total += $_.Length; "
+        "if ($total -gt {1}) {{ Remove-Item -LiteralPath $_.FullName -Force }} }} }}"
+    ).format(quote_ps_string(cache_dir), int(max_size))
 
 
-def adjust_regex(line: str, escape_regex_characters: bool) -> str:
+# Locally fetched files (by cache key) and the locks held while fetching them
+_local_fetches: dict[str, str] = {}
+_local_fetch_locks: dict[str, Semaphore] = {}
+_upload_semaphores: dict[int, BoundedSemaphore] = {}
+
+
+def get_upload_semaphore(concurrency: int) -> BoundedSemaphore:
     """
-    Ensure the regex starts with '^' and ends with '$' and escape regex characters if requested
+    Returns the semaphore shared by all hosts uploading with the same concurrency limit.
     """
-    match_line = line
 
-    if escape_regex_characters:
-        match_line = re.sub(r"([\.\\\+\*\?\[\^\]\$\(\)\{\}\-])", r"\\\1", match_line)
+    if concurrency not in _upload_semaphores:
+        _upload_semaphores[concurrency] = BoundedSemaphore(concurrency)
+    return _upload_semaphores[concurrency]
 
-    # Ensure we're matching a whole line, note: match may be a partial line so we
-    # put any matches on either side.
-    if not match_line.startswith("^"):
-        match_line = "^.*{0}".format(match_line)
-    if not match_line.endswith("$"):
-        match_line = "{0}.*$".format(match_line)
 
-    return match_line
+def get_local_cache_dir() -> str:
+    """
+    Returns the directory files fetched by pyinfra are cached in, creating it
+    readable by the current user only.
+    """
+
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"),
+        ".cache",
+    )
+    cache_dir = os.path.join(cache_home, "pyinfra-windows", "downloads")
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    os.chmod(cache_dir, 0o700)
+    return cache_dir
+
+
+def _check_file_hashes(filename: str, hashes: dict[str, str], chunk_size: int) -> bool:
+    hashers = {name: hashlib.new(name.lower()) for name in hashes}
+    with open(filename, "rb") as file_io:
+        while True:
+            chunk = file_io.read(chunk_size)
+            if not chunk:
+                break
+            for hasher in hashers.values():
+                hasher.update(chunk)
+
+    return all(
+        hasher.hexdigest() == hashes[name].lower() for name, hasher in hashers.items()
+    )
+
+
+def fetch_to_local_cache(
+    src: str,
+    hashes: dict[str, str] | None = None,
+    cache_dir: str | None = None,
+    chunk_size: int = 1024 * 1024,
+) -> str:
+    """
+    Downloads ``src`` on the machine running pyinfra, verifying ``hashes`` (algorithm
+    name -> expected hex digest), and returns the local filename. Concurrent callers
+    for the same file wait for a single download.
+
+    Files verified against a checksum are reused across runs (after checking them
+    again), others are fetched once per run. By default they are kept in a directory
+    only readable by the current user.
+    """
+
+    hashes = hashes or {}
+    if cache_dir is None:
+        cache_dir = get_local_cache_dir()
+    cache_key = sha1_hash(
+        "{0} {1}".format(
+            src,
+            " ".join(
+                "{0}={1}".format(name.lower(), value.lower())
+                for name, value in sorted(hashes.items())
+            ),
+        ),
+    )
+    filename = os.path.join(cache_dir, cache_key)
+
+    lock = _local_fetch_locks.setdefault(cache_key, Semaphore())
+    with lock:
+        if cache_key in _local_fetches:
+            return filename
+
+        # Files left by a previous run may have been changed since
+        if hashes and os.path.isfile(filename):
+            if _check_file_hashes(filename, hashes, chunk_size):
+                _local_fetches[cache_key] = filename
+                return filename
+            os.remove(filename)
+
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        hashers = {name: hashlib.new(name.lower()) for name in hashes}
+        temp_filename = "{0}.part".format(filename)
+
+        with urlopen(src) as response, open(temp_filename, "wb") as file_io:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                file_io.write(chunk)
+                for hasher in hashers.values():
+                    hasher.update(chunk)
+
+        for name, hasher in hashers.items():
+            if hasher.hexdigest() != hashes[name].lower():
+                os.remove(temp_filename)
+                raise OperationError("{0} did not match!".format(name))
+
+        os.replace(temp_filename, filename)
+        _local_fetches[cache_key] = filename
+
+    return filename
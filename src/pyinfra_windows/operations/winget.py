@@ -4,41 +4,120 @@ Manage ``winget`` packages (https://learn.microsoft.com/en-us/windows/package-ma
 
 from __future__ import annotations
 
+import re
+
 from pyinfra import host
 from pyinfra.api import operation
-from pyinfra.operations.util.packaging import PkgInfo, ensure_packages
-
-from pyinfra_windows.facts.winget import WingetPackages
-
+from pyinfra.operations.util.packaging import PkgInfo
+
+from pyinfra_windows.connectors.util import quote_ps_string
+from pyinfra_windows.facts.winget import WINGET_PACKAGES_CACHE, WingetPackages
+
+# Runs the winget commands of each package in a single PowerShell session and
+# reports a result line per package, failing if any of them failed.
+PACKAGES_SCRIPT = """$failed = $false
+Remove-Item -LiteralPath {cache} -ErrorAction SilentlyContinue
+{source_update}foreach ($package in @({packages})) {{
+    foreach ($arguments in $package.Commands) {{
+        $output = & winget @arguments 2>&1
+        if ($LASTEXITCODE -ne 0) {{ break }}
+    }}
+    if ($LASTEXITCODE -eq 0) {{ "$($package.Id): $($package.Done)" }} else {{
+        $failed = $true; $output; "$($package.Id): failed ($LASTEXITCODE)"
+    }}
+}}
+if ($failed) {{ exit 1 }}"""
+
+
+def _parse_version(version: str):
+    try:
+        return tuple(int(part) for part in re.split(r"[.-]", version))
+    except ValueError:
+        return None
+
+
+def _get_package_commands(package: PkgInfo, installed_versions, present: bool):
+    """
+    Returns the winget arguments to run for a package, and what they did.
+    """
 
-def _package_install_format_fn(name: str, operator: str, version: str):
-    if version == "_no_version":
-        return "winget install --no-upgrade --silent --exact {name};".format(
-            name=name,
+    def make_arguments(action, *extra):
+        return [action, "--id", package.name, "--exact", "--silent", *extra]
+
+    version = ["--version", package.version] if package.has_version else []
+
+    if not present:
+        return [make_arguments("uninstall", *version)], "uninstalled"
+
+    if installed_versions is None:
+        return [make_arguments("install", "--no-upgrade", *version)], "installed"
+
+    # winget install refuses installed packages, upgrade only goes up: another
+    # version is upgraded to if newer than all installed, otherwise reinstalled
+    wanted = _parse_version(package.version)
+    installed = [_parse_version(v) for v in installed_versions]
+    if wanted is not None and all(v is not None and v < wanted for v in installed):
+        return [make_arguments("upgrade", *version)], "upgraded"
+
+    return [
+        make_arguments("uninstall", "--all-versions"),
+        make_arguments("install", *version),
+    ], "reinstalled"
+
+
+def _make_packages_command(packages: list[tuple[PkgInfo, set | None]], present: bool):
+    # Refresh the sources once, so each install doesn't have to
+    source_update = "winget source update | Out-Null\n" if present else ""
+
+    package_lines = []
+    for package, installed_versions in packages:
+        commands, done = _get_package_commands(package, installed_versions, present)
+        package_lines.append(
+            "@{{Id = {0}; Done = '{1}'; Commands = @({2}{3})}}".format(
+                quote_ps_string(package.name),
+                done,
+                # A single array needs the comma to not be unrolled
+                "," if len(commands) == 1 else "",
+                ", ".join(
+                    "@({0})".format(", ".join(quote_ps_string(arg) for arg in command))
+                    for command in commands
+                ),
+            ),
         )
-    return "winget install --no-upgrade --silent --exact {name} {operator} {version};".format(
-        name=name, operator=operator, version=version
-    )
 
-
-def _package_uninstall_format_fn(name: str, operator: str, version: str):
-    if version == "_no_version":
-        return "winget uninstall --silent --exact {name};".format(name=name)
-    return "winget uninstall --silent --exact {name} {operator} {version};".format(
-        name=name, operator=operator, version=version
+    return PACKAGES_SCRIPT.format(
+        cache=WINGET_PACKAGES_CACHE,
+        source_update=source_update,
+        packages=", ".join(package_lines),
     )
 
 
 @operation()
-def packages(packages: str | list[str] | None = None, present=True):
+def packages(
+    packages: str | list[str] | None = None,
+    present=True,
+    cache_time: int | None = None,
+):
     """
     Add/remove/update ``winget`` packages.
 
     + packages: list of packages to ensure. Must be specified via winget package ids.
     + present: whether the packages should be installed
+    + cache_time: use the package list cached on the host if newer than this (in seconds)
 
     Versions:
-        Package versions can be pinned like apt: ``<pkg>=<version>``.
+        Package versions can be pinned like apt: ``<pkg>=<version>``. An installed
+        package with another version is upgraded to a newer version, or uninstalled
+        and installed again for older (or not comparable) versions.
+
+    Batching:
+        All packages that need changing are handled by a single PowerShell script,
+        which refreshes the winget sources once and prints a result line for each
+        package. The operation fails if any package fails.
+
+    ``cache_time``:
+        See the ``WingetPackages`` fact, the cache is removed whenever this operation
+        changes packages.
 
     **Example:**
 
@@ -51,44 +130,41 @@ def packages(packages: str | list[str] | None = None, present=True):
             packages=["Notepad++.Notepad++"],
         )
     """
-    # TODO when an older version of a package
-    # exists and a newer version is requested
-    # winget still runs but raises an error
-
     if not packages:
         return
 
     if isinstance(packages, str):
         packages = [packages]
 
-    packages: list[str] = packages
+    requested_packages = [PkgInfo.from_possible_pair(p, "=") for p in packages]
+    current_packages = host.get_fact(
+        WingetPackages,
+        package_ids=[package.name for package in requested_packages],
+        cache_time=cache_time,
+    )
+
+    # winget package ids are case insensitive
+    current_packages = {
+        package_id.lower(): versions
+        for package_id, versions in current_packages.items()
+    }
+
+    diff_packages: list[tuple[PkgInfo, set | None]] = []
+    for package in requested_packages:
+        installed_versions = current_packages.get(package.name.lower())
 
-    requested_packages: list[PkgInfo] = []
-    for p in packages:
-        inst_vers_format_fn = None
         if present:
-            inst_vers_format_fn = _package_install_format_fn
+            if installed_versions is None or (
+                package.has_version and package.version not in installed_versions
+            ):
+                diff_packages.append((package, installed_versions))
+            else:
+                host.noop("package {0} is installed".format(package.name))
+
+        elif installed_versions is not None:
+            diff_packages.append((package, installed_versions))
         else:
-            inst_vers_format_fn = _package_uninstall_format_fn
-        # this is a hack to support winget install package --version version
-        # each package must have it's own winget install command
-        p = p.replace("=", "--version")
-        package_info = PkgInfo.from_possible_pair(p, "--version")
-        # we use "_no_version" when version is not specified
-        pkg_info_wrapper = PkgInfo(
-            name=package_info.name,
-            operator=package_info.operator,
-            version=package_info.version or "_no_version",
-            url="",
-            inst_vers_format_fn=inst_vers_format_fn,
-        )
-        requested_packages.append(pkg_info_wrapper)
-
-    yield from ensure_packages(
-        host,
-        requested_packages,
-        host.get_fact(WingetPackages),
-        present,
-        install_command="",
-        uninstall_command="",
-    )
+            host.noop("package {0} is not installed".format(package.name))
+
+    if diff_packages:
+        yield _make_packages_command(diff_packages, present)
@@ -0,0 +1,320 @@
+"""
+Throughput benchmarks for the ``@winrm`` connector, run against the fake WinRM
+server (``tests/winrm_server.py``) at several injected latencies.
+
+Measures commands per second, ``put_file`` upload throughput, command output
+("download") throughput, the time to gather every ``facts/server.py`` fact and
+the peak client memory. Run standalone to save JSON results and compare them
+against the stored baseline:
+
+.. code:: sh
+
+    python -m tests.benchmarks.bench_connector --output results.json
+    python -m tests.benchmarks.bench_connector --latencies 0,0.02 --upload-sizes 1K,1M,1G
+
+Absolute results depend on the machine, so results are compared against the
+baseline relative to the command rate at the same latency, leaving out the peak
+memory. Pass ``--absolute`` to compare the absolute results against a baseline
+saved on the same machine.
+
+Or through pytest (quick settings, fails on relative regressions against the
+baseline):
+
+.. code:: sh
+
+    pytest tests/benchmarks/bench_connector.py
+"""
+
+from __future__ import annotations
+
+import json
+import re
+from inspect import signature
+from io import BytesIO
+from os import listdir, path
+
+import click
+from pyinfra.api import Config, FactBase, State
+
+from pyinfra_windows.facts import server as server_facts
+
+from ..util import make_inventory
+from ..winrm_server import CommandResult, FakeWinRMServer
+from .util import (
+    DEFAULT_TOLERANCE,
+    BenchmarkResults,
+    format_size,
+    get_peak_rss_mb,
+    load_baseline,
+    parse_size,
+    save_results,
+    timed,
+)
+
+BASELINE_FILENAME = path.join(path.dirname(__file__), "baseline_connector.json")
+FACTS_DIRECTORY = path.join(path.dirname(__file__), "..", "facts")
+
+# Roughly what a real WinRM service returns per Receive (MaxEnvelopeSize is 150KB)
+RECEIVE_CHUNK_SIZE = 100 * 1024
+
+QUICK_SETTINGS = {
+    "latencies": [0, 0.002],
+    "commands": 50,
+    "upload_sizes": [1024, 64 * 1024, 1024**2],
+    "download_sizes": [1024**2],
+    "fact_rounds": 2,
+}
+
+
+def _get_server_fact_fixtures():
+    """
+    Yields ``(fact class, kwargs, output)`` for each fact in ``facts/server.py``,
+    using the first test fixture for it.
+    """
+
+    for name, fact_cls in vars(server_facts).items():
+        if (
+            not isinstance(fact_cls, type)
+            or not issubclass(fact_cls, FactBase)
+            or fact_cls.__module__ != server_facts.__name__
+        ):
+            continue
+
+        fixture_directory = path.join(FACTS_DIRECTORY, "server.{0}".format(name))
+        if not path.isdir(fixture_directory):
+            continue
+
+        filename = sorted(listdir(fixture_directory))[0]
+        with open(path.join(fixture_directory, filename), encoding="utf-8") as f:
+            fixture = json.load(f)
+
+        args = fixture.get("arg", [])
+        if not isinstance(args, list):
+            args = [args]
+        command = fact_cls().command
+        kwargs = {}
+        if callable(command):
+            kwargs = dict(zip(signature(command).parameters, args))
+
+        yield fact_cls, kwargs, fixture["output"]
+
+
+def _connect(server):
+    inventory = make_inventory(
+        hosts=("@winrm/benchmark",),
+        override_data={
+            "winrm_hostname": server.endpoint,
+            "ssh_user": "user",
+            "ssh_password": "pass",
+        },
+    )
+    State(inventory, Config())
+    host = inventory.get_host("@winrm/benchmark")
+    host.connect()
+    return host
+
+
+def _make_server(latency):
+    server = FakeWinRMServer(latency=latency, receive_chunk_size=RECEIVE_CHUNK_SIZE)
+    server.add_response("^Write-Output benchmark$", CommandResult("benchmark"))
+    server.add_response(r"GetTempPath\(\)", CommandResult("C:\\Temp\\\r\n"))
+    server.add_response("FromBase64String", CommandResult())
+    server.add_response("^Move-Item", CommandResult())
+
+    def download(script):
+        size = int(re.search("^Get-Bytes ([0-9]+)$", script).group(1))
+        return CommandResult(b"x" * size)
+
+    server.add_response("^Get-Bytes", download)
+
+    for fact_cls, kwargs, output in _get_server_fact_fixtures():
+        command = fact_cls().command
+        if callable(command):
+            command = command(**kwargs)
+        server.add_response(
+            "^{0}$".format(re.escape(command)),
+            CommandResult("\r\n".join(output)),
+        )
+
+    return server
+
+
+def run_benchmarks(
+    latencies,
+    commands,
+    upload_sizes,
+    download_sizes,
+    fact_rounds,
+):
+    results = BenchmarkResults()
+
+    for latency in latencies:
+        label = "latency={0:g}ms".format(latency * 1000)
+
+        with _make_server(latency) as server:
+            host = _connect(server)
+            # Keep one off setup (imports, the first connection) out of the timings
+            host.run_shell_command("Write-Output benchmark")
+
+            elapsed = timed(
+                lambda: [
+                    host.run_shell_command("Write-Output benchmark")
+                    for _ in range(commands)
+                ],
+            )
+            results.add(
+                "commands/{0}".format(label),
+                commands / elapsed,
+                "cmd/s",
+            )
+
+            for size in upload_sizes:
+                data = b"x" * size
+                elapsed = timed(host.put_file, BytesIO(data), "C:\\benchmark.bin")
+                results.add(
+                    "put_file/{0}/{1}".format(format_size(size), label),
+                    size / 1024**2 / elapsed,
+                    "MB/s",
+                )
+
+            for size in download_sizes:
+                elapsed = timed(host.run_shell_command, "Get-Bytes {0}".format(size))
+                results.add(
+                    "output/{0}/{1}".format(format_size(size), label),
+                    size / 1024**2 / elapsed,
+                    "MB/s",
+                )
+
+            fact_fixtures = list(_get_server_fact_fixtures())
+            elapsed = timed(
+                lambda: [
+                    host.get_fact(fact_cls, **kwargs)
+                    for _ in range(fact_rounds)
+                    for fact_cls, kwargs, _ in fact_fixtures
+                ],
+            )
+            results.add(
+                "server_facts/{0}".format(label),
+                elapsed / fact_rounds,
+                "s",
+                higher_is_better=False,
+            )
+
+    peak_rss = get_peak_rss_mb()
+    if peak_rss is not None:
+        results.add("peak_rss", peak_rss, "MB", higher_is_better=False)
+
+    return results
+
+
+def get_relative_results(results):
+    """
+    Express results relative to the command rate at the same latency, which stays
+    comparable between machines of different speeds. Results without a command
+    rate to compare to (the peak memory) are left out.
+    """
+
+    relative = BenchmarkResults()
+    for name, result in results.items():
+        label = name.rsplit("/", 1)[-1]
+        reference_name = "commands/{0}".format(label)
+        if name == reference_name or reference_name not in results:
+            continue
+
+        # Throughputs become the KB transferred and times the number of commands
+        # run in the time of one command
+        reference = results[reference_name]["value"]
+        if result["unit"] == "MB/s":
+            value, unit = result["value"] * 1024 / reference, "KB/cmd"
+        else:
+            value, unit = result["value"] * reference, "cmds"
+        relative.add(name, value, unit, higher_is_better=result["higher_is_better"])
+    return relative
+
+
+def test_connector_benchmarks():
+    results = run_benchmarks(**QUICK_SETTINGS)
+    baseline = load_baseline(BASELINE_FILENAME)
+    if baseline:
+        relative = get_relative_results(results.results)
+        relative_baseline = get_relative_results(baseline).results
+        assert relative.get_regressions(relative_baseline, tolerance=0.5) == []
+
+
+@click.command()
+@click.option("--output", help="Write the results as JSON to this file.")
+@click.option(
+    "--baseline",
+    default=BASELINE_FILENAME,
+    show_default=True,
+    help="Compare against the results in this file.",
+)
+@click.option("--save-baseline", is_flag=True, help="Save the results as the baseline.")
+@click.option("--tolerance", default=DEFAULT_TOLERANCE, show_default=True)
+@click.option(
+    "--absolute",
+    is_flag=True,
+    help="Compare the absolute results, for a baseline from this machine.",
+)
+@click.option(
+    "--latencies",
+    default=",".join(str(latency) for latency in QUICK_SETTINGS["latencies"]),
+    show_default=True,
+    help="Comma separated latencies (seconds) to inject per request.",
+)
+@click.option("--commands", default=QUICK_SETTINGS["commands"], show_default=True)
+@click.option(
+    "--upload-sizes",
+    default=",".join(format_size(size) for size in QUICK_SETTINGS["upload_sizes"]),
+    show_default=True,
+)
+@click.option(
+    "--download-sizes",
+    default=",".join(format_size(size) for size in QUICK_SETTINGS["download_sizes"]),
+    show_default=True,
+)
+@click.option("--fact-rounds", default=QUICK_SETTINGS["fact_rounds"], show_default=True)
+def main(
+    output,
+    baseline,
+    save_baseline,
+    tolerance,
+    absolute,
+    latencies,
+    commands,
+    upload_sizes,
+    download_sizes,
+    fact_rounds,
+):
+    results = run_benchmarks(
+        latencies=[float(latency) for latency in latencies.split(",")],
+        commands=commands,
+        upload_sizes=[parse_size(size) for size in upload_sizes.split(",")],
+        download_sizes=[parse_size(size) for size in download_sizes.split(",")],
+        fact_rounds=fact_rounds,
+    )
+
+    baseline_results = None if save_baseline else load_baseline(baseline)
+
+    compared_results = results
+    if baseline_results and not absolute:
+        click.echo(results.format_table())
+        click.echo()
+        compared_results = get_relative_results(results.results)
+        baseline_results = get_relative_results(baseline_results).results
+    click.echo(compared_results.format_table(baseline_results, tolerance))
+
+    if output:
+        save_results(output, compared_results, baseline_results, tolerance)
+    if save_baseline:
+        save_results(baseline, results)
+
+    if baseline_results and compared_results.get_regressions(
+        baseline_results,
+        tolerance,
+    ):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
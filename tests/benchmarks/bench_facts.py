@@ -0,0 +1,559 @@
+"""
+Microbenchmarks for the fact output parsers, using large generated outputs.
+
+Reports the parse time and peak allocated memory for each parser and fails when
+a parser exceeds its thresholds, when the parse time grows faster than linearly
+with the output size or when a result regresses against the stored baseline.
+Also reports the memory kept by the ``Processes`` results of many hosts, with
+and without compact records:
+
+.. code:: sh
+
+    python -m tests.benchmarks.bench_facts --output results.json
+    pytest tests/benchmarks/bench_facts.py
+"""
+
+from __future__ import annotations
+
+import gc
+import json
+import random
+import tracemalloc
+from os import path
+from time import perf_counter
+from unittest import mock
+
+import click
+import pytest
+
+from pyinfra_windows.facts.files import FindFiles
+from pyinfra_windows.facts.server import (
+    ComputerInfo,
+    Hotfixes,
+    Processes,
+    Services,
+)
+from pyinfra_windows.facts.util import format_list
+from pyinfra_windows.facts.util.win_files import parse_win_ls_output
+from pyinfra_windows.facts.winget import WingetPackages
+
+from .util import (
+    DEFAULT_TOLERANCE,
+    BenchmarkResults,
+    load_baseline,
+    save_results,
+)
+
+BASELINE_FILENAME = path.join(path.dirname(__file__), "baseline_facts.json")
+
+# Format-List wraps values at the console width
+CONSOLE_WIDTH = 120
+
+# Parse time ratio allowed for four times the output, above which a parser is
+# taken to be worse than linear (a quadratic parser would be ~16x slower)
+SCALING_FACTOR = 4
+MAX_SCALING_RATIO = 8
+
+# Hosts whose Processes results are kept, and the minimum ratio of the memory
+# kept by regular to compact records
+RETAINED_HOSTS = 20
+MIN_RETAINED_RATIO = 10
+
+PROCESSES_FIXTURE = path.join(
+    path.dirname(path.dirname(__file__)),
+    "facts",
+    "server.Processes",
+    "server_processes.json",
+)
+
+# Get-Process properties holding the same counter as another (aliases, 64 bit)
+PROCESS_COUNTERS = {
+    "HandleCount": ("Handles",),
+    "WorkingSet": ("WS", "WorkingSet64"),
+    "PagedMemorySize": (
+        "PM",
+        "PagedMemorySize64",
+        "PrivateMemorySize",
+        "PrivateMemorySize64",
+    ),
+    "VirtualMemorySize": (),
+    "VM": ("VirtualMemorySize64", "PeakVirtualMemorySize64"),
+    "NPM": ("NonpagedSystemMemorySize", "NonpagedSystemMemorySize64"),
+    "PagedSystemMemorySize": ("PagedSystemMemorySize64",),
+    "PeakPagedMemorySize": ("PeakPagedMemorySize64",),
+    "PeakWorkingSet": ("PeakWorkingSet64",),
+    "PeakVirtualMemorySize": (),
+    "Handle": (),
+}
+
+# Benchmarks known to fail -> reason, reported but not failing the run
+EXPECTED_FAILURES: dict[str, str] = {}
+
+
+def make_format_list_output(count, primary_key, fields, wrapped_lines=0):
+    """
+    Generate ``Format-List -Property *`` output for ``count`` objects, with the
+    given number of continuation lines for a ``Description`` property.
+    """
+
+    names = [primary_key] + list(fields)
+    if wrapped_lines:
+        names.append("Description")
+    width = max(len(name) for name in names)
+    value_width = CONSOLE_WIDTH - width - 3
+
+    output = ["", ""]
+    for i in range(count):
+        output.append("{0} : {1}-{2}".format(primary_key.ljust(width), primary_key, i))
+        for field in fields:
+            output.append(
+                "{0} : {1} value for {2} {3}".format(
+                    field.ljust(width), field, i, i * 7
+                )
+            )
+        if wrapped_lines:
+            output.append(
+                "{0} : {1}".format("Description".ljust(width), "d" * value_width)
+            )
+            output.extend(
+                " " * (width + 3) + "x" * value_width for _ in range(wrapped_lines)
+            )
+        output.append("")
+    output.append("")
+    return output
+
+
+def make_cim_output(count, primary_key, fields):
+    """
+    Generate ``CimQuery`` output (a JSON object per line) for ``count`` instances.
+    """
+
+    return [
+        json.dumps(
+            dict(
+                [(primary_key, "{0}-{1}".format(primary_key, i))]
+                + [
+                    (field, "{0} value for {1} {2}".format(field, i, i * 7))
+                    for field in fields
+                ],
+            ),
+            separators=(",", ":"),
+        )
+        for i in range(count)
+    ]
+
+
+def make_ls_output(count):
+    return [
+        "-a----        9/15/2018  12:16 AM       {0:>8} file-{1}.txt".format(i * 13, i)
+        for i in range(count)
+    ]
+
+
+def make_find_files_output(count):
+    return [
+        "{0}\t2024-01-02T03:04:05\tC:\\logs\\app-{1}\\file-{2}.log".format(
+            i * 13, i // 1000, i
+        )
+        for i in range(count)
+    ]
+
+
+def make_winget_output(count):
+    return [
+        json.dumps(
+            {"Id": "Vendor.Package{0}".format(i), "Version": "1.{0}.0".format(i)}
+        )
+        for i in range(count)
+    ]
+
+
+PROCESS_FIELDS = [
+    "Name",
+    "Handles",
+    "VM",
+    "WS",
+    "PM",
+    "NPM",
+    "Path",
+    "Company",
+    "CPU",
+    "FileVersion",
+    "ProductVersion",
+    "Description",
+    "Product",
+    "SessionId",
+    "StartTime",
+    "Threads",
+    "PriorityClass",
+    "MainWindowTitle",
+]
+
+SERVICE_FIELDS = [
+    "DisplayName",
+    "State",
+    "StartMode",
+    "ProcessId",
+    "PathName",
+    "StartName",
+    "ServiceType",
+    "Status",
+    "AcceptStop",
+    "AcceptPause",
+    "DelayedAutoStart",
+    "ExitCode",
+]
+
+HOTFIX_FIELDS = ["Description", "InstalledBy", "InstalledOn", "Caption", "Status"]
+
+
+def make_host_processes_output(seed, count=200, executables=150):
+    """
+    Generate the ``Get-Process | Format-List -Property *`` output of a host, for
+    processes of a set of executables common to all hosts (based on the fixture
+    processes) with their own counters, times and threads.
+    """
+
+    with open(PROCESSES_FIXTURE, encoding="utf-8") as f:
+        templates = list(json.load(f)["fact"]["Id"].values())
+
+    rng = random.Random(seed)
+    width = max(len(name) for name in templates[0]) + 1
+    output = ["", ""]
+    for _ in range(count):
+        executable = rng.randrange(executables)
+        process = dict(templates[executable % len(templates)])
+        name = "{0}{1}".format(process["Name"], executable)
+        process.update(
+            Name=name,
+            ProcessName=name,
+            Path="C:\\Program Files\\Vendor{0}\\{1}.exe".format(executable, name),
+            Description="Description of {0}".format(name),
+            MainModule="System.Diagnostics.ProcessModule ({0}.exe)".format(name),
+        )
+        for counter, aliases in PROCESS_COUNTERS.items():
+            value = str(rng.randrange(10**4, 10**10))
+            for key in (counter,) + aliases:
+                process[key] = value
+
+        cpu = rng.random() * 100
+        process.update(
+            CPU=repr(round(cpu, 6)),
+            TotalProcessorTime="00:0{0}:{1:010.7f}".format(rng.randrange(10), cpu % 60),
+            UserProcessorTime="00:00:{0:010.7f}".format(rng.random() * 60),
+            PrivilegedProcessorTime="00:00:{0:010.7f}".format(rng.random() * 60),
+            StartTime="1/{0}/2020 {1}:{2:02d}:{3:02d} PM".format(
+                rng.randrange(1, 29),
+                rng.randrange(1, 12),
+                rng.randrange(60),
+                rng.randrange(60),
+            ),
+            Threads="{{{0}...}}".format(
+                ", ".join(str(rng.randrange(10000)) for _ in range(3)),
+            ),
+        )
+
+        output.append("{0}: {1}".format("Id".ljust(width), rng.randrange(100000)))
+        output.extend(
+            "{0}: {1}".format(key.ljust(width), value) for key, value in process.items()
+        )
+        output.append("")
+    output.append("")
+    return output
+
+
+def _make_fact_parser(fact_cls, **kwargs):
+    fact = fact_cls()
+    fact.command(**kwargs)
+    return fact.process
+
+
+def _parse_ls(output):
+    return [parse_win_ls_output(line, "file") for line in output]
+
+
+# name -> (parser, make output for a size, size, max seconds, max MB)
+BENCHMARKS = {
+    "processes_2000": (
+        _make_fact_parser(Processes),
+        lambda size: make_format_list_output(size, "Id", PROCESS_FIELDS),
+        2000,
+        1.0,
+        64,
+    ),
+    "processes_2000_compact": (
+        _make_fact_parser(Processes, compact=True),
+        lambda size: make_format_list_output(size, "Id", PROCESS_FIELDS),
+        2000,
+        1.0,
+        64,
+    ),
+    "services_500": (
+        _make_fact_parser(Services),
+        lambda size: make_cim_output(size, "Name", SERVICE_FIELDS),
+        500,
+        0.5,
+        16,
+    ),
+    "hotfixes_1000": (
+        _make_fact_parser(Hotfixes),
+        lambda size: make_format_list_output(size, "HotFixID", HOTFIX_FIELDS),
+        1000,
+        0.5,
+        16,
+    ),
+    "wrapped_values_2000_lines": (
+        _make_fact_parser(Processes),
+        lambda size: make_format_list_output(10, "Id", PROCESS_FIELDS, size),
+        2000,
+        0.5,
+        16,
+    ),
+    "computer_info_5000": (
+        ComputerInfo.process,
+        lambda size: [
+            "{0} : value {1}".format("Property{0}".format(i).ljust(30), i)
+            for i in range(size)
+        ],
+        5000,
+        0.5,
+        16,
+    ),
+    "ls_10000": (_parse_ls, make_ls_output, 10000, 1.0, 32),
+    "find_files_100000": (
+        FindFiles().process,
+        make_find_files_output,
+        100000,
+        1.0,
+        64,
+    ),
+    "winget_5000": (
+        WingetPackages().process,
+        make_winget_output,
+        5000,
+        0.5,
+        16,
+    ),
+}
+
+
+def _measure_time(parser, output, repeat):
+    # Like timeit, keep garbage collection out of the timings
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        best = None
+        for _ in range(repeat):
+            start = perf_counter()
+            parser(output)
+            elapsed = perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def _measure_memory(parser, output):
+    tracemalloc.start()
+    try:
+        parser(output)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1024**2
+
+
+def _measure_retained(parser, outputs):
+    """
+    Returns the KB kept per host by the parsed results of each output.
+    """
+
+    # A new shared builder, so the values it keeps are counted
+    with mock.patch.object(format_list, "_record_builder", format_list.RecordBuilder()):
+        gc.collect()
+        tracemalloc.start()
+        try:
+            results = [parser(output) for output in outputs]
+            gc.collect()
+            retained, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    assert len(results) == len(outputs)
+    return retained / len(outputs) / 1024
+
+
+def run_retained_benchmark(hosts=RETAINED_HOSTS):
+    """
+    Returns the results and a list of ``(name, failure)`` tuples for the memory
+    kept by the Processes results of many hosts.
+    """
+
+    results = BenchmarkResults()
+    failures = []
+
+    outputs = [make_host_processes_output(seed) for seed in range(hosts)]
+    regular = _measure_retained(_make_fact_parser(Processes), outputs)
+    compact = _measure_retained(_make_fact_parser(Processes, compact=True), outputs)
+    ratio = regular / compact
+
+    results.add("processes_retained/regular", regular, "KB", higher_is_better=False)
+    results.add("processes_retained/compact", compact, "KB", higher_is_better=False)
+    results.add("processes_retained/ratio", ratio, "x")
+
+    if ratio < MIN_RETAINED_RATIO:
+        failures.append(
+            (
+                "processes_retained",
+                "compact records are {0:.1f}x smaller (min {1}x)".format(
+                    ratio,
+                    MIN_RETAINED_RATIO,
+                ),
+            ),
+        )
+
+    return results, failures
+
+
+def run_benchmarks(repeat=5, names=None):
+    """
+    Returns the results and a list of ``(name, failure)`` tuples.
+
+    + repeat: number of timed runs to take the best of
+    + names: only run these benchmarks, defaults to all of them
+    """
+
+    results = BenchmarkResults()
+    failures = []
+
+    for name in names or BENCHMARKS:
+        parser, make_output, size, max_seconds, max_mb = BENCHMARKS[name]
+        output = make_output(size)
+        seconds = _measure_time(parser, output, repeat)
+        memory = _measure_memory(parser, output)
+        scaling = (
+            _measure_time(parser, make_output(size * SCALING_FACTOR), repeat) / seconds
+        )
+
+        results.add(
+            "{0}/time".format(name), seconds * 1000, "ms", higher_is_better=False
+        )
+        results.add("{0}/memory".format(name), memory, "MB", higher_is_better=False)
+        results.add(
+            "{0}/scaling".format(name),
+            scaling,
+            "x",
+            higher_is_better=False,
+        )
+
+        if seconds > max_seconds:
+            failures.append(
+                (name, "took {0:.3f}s (max {1}s)".format(seconds, max_seconds)),
+            )
+        if memory > max_mb:
+            failures.append(
+                (name, "allocated {0:.1f}MB (max {1}MB)".format(memory, max_mb)),
+            )
+        if scaling > MAX_SCALING_RATIO:
+            failures.append(
+                (
+                    name,
+                    "{0:.1f}x slower for {1}x the output (max {2}x)".format(
+                        scaling,
+                        SCALING_FACTOR,
+                        MAX_SCALING_RATIO,
+                    ),
+                ),
+            )
+
+    return results, failures
+
+
+@pytest.mark.parametrize(
+    "name",
+    [
+        pytest.param(
+            name,
+            marks=pytest.mark.xfail(reason=EXPECTED_FAILURES[name], strict=True),
+        )
+        if name in EXPECTED_FAILURES
+        else name
+        for name in BENCHMARKS
+    ],
+)
+def test_fact_parser_benchmarks(name):
+    results, failures = run_benchmarks(names=[name])
+    assert [failure for _, failure in failures] == []
+
+    baseline = load_baseline(BASELINE_FILENAME)
+    if baseline:
+        # Timings vary by machine, so only allocations are compared here
+        baseline = {
+            name: result
+            for name, result in baseline.items()
+            if name.endswith("/memory")
+        }
+        assert results.get_regressions(baseline) == []
+
+
+def test_compact_records_retained_size():
+    results, failures = run_retained_benchmark()
+    assert [failure for _, failure in failures] == []
+
+    baseline = load_baseline(BASELINE_FILENAME)
+    if baseline:
+        assert results.get_regressions(baseline) == []
+
+
+@click.command()
+@click.option("--output", help="Write the results as JSON to this file.")
+@click.option(
+    "--baseline",
+    default=BASELINE_FILENAME,
+    show_default=True,
+    help="Compare against the results in this file.",
+)
+@click.option("--save-baseline", is_flag=True, help="Save the results as the baseline.")
+@click.option("--tolerance", default=DEFAULT_TOLERANCE, show_default=True)
+@click.option("--repeat", default=5, show_default=True)
+def main(output, baseline, save_baseline, tolerance, repeat):
+    results, failures = run_benchmarks(repeat=repeat)
+    retained_results, retained_failures = run_retained_benchmark()
+    results.results.update(retained_results.results)
+    failures += retained_failures
+
+    baseline_results = None if save_baseline else load_baseline(baseline)
+    if baseline_results:
+        # Scaling is noisy and has its own threshold
+        baseline_results = {
+            name: result
+            for name, result in baseline_results.items()
+            if not name.endswith("/scaling")
+        }
+    click.echo(results.format_table(baseline_results, tolerance))
+    for name, failure in failures:
+        if name in EXPECTED_FAILURES:
+            click.echo(
+                "XFAIL: {0}: {1} ({2})".format(name, failure, EXPECTED_FAILURES[name]),
+                err=True,
+            )
+        else:
+            click.echo("FAILED: {0}: {1}".format(name, failure), err=True)
+    failures = [
+        (name, failure) for name, failure in failures if name not in EXPECTED_FAILURES
+    ]
+
+    if output:
+        save_results(output, results, baseline_results, tolerance)
+    if save_baseline:
+        save_results(baseline, results)
+
+    if failures or (
+        baseline_results and results.get_regressions(baseline_results, tolerance)
+    ):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Shared helpers for the benchmarks: timing, collecting results and comparing them
+against a stored baseline.
+"""
+
+from __future__ import annotations
+
+import json
+from os import path
+from time import perf_counter
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None  # type: ignore
+
+# Relative change allowed before a result counts as a regression
+DEFAULT_TOLERANCE = 0.25
+
+
+def timed(func, *args, **kwargs):
+    """
+    Call a function, returning the elapsed seconds.
+    """
+
+    start = perf_counter()
+    func(*args, **kwargs)
+    return perf_counter() - start
+
+
+def get_peak_rss_mb():
+    """
+    Peak resident memory of this process in MB, or ``None`` when not available.
+    """
+
+    if resource is None:
+        return None
+    # ru_maxrss is KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def parse_size(value):
+    """
+    Parse sizes like ``512``, ``64K``, ``1M`` or ``1G`` into bytes.
+    """
+
+    value = value.strip().upper()
+    for suffix, multiplier in (("K", 1024), ("M", 1024**2), ("G", 1024**3)):
+        if value.endswith(suffix):
+            return int(float(value[:-1]) * multiplier)
+    return int(value)
+
+
+def format_size(size):
+    for suffix, multiplier in (("G", 1024**3), ("M", 1024**2), ("K", 1024)):
+        if size >= multiplier and size % multiplier == 0:
+            return "{0}{1}".format(size // multiplier, suffix)
+    return str(size)
+
+
+class BenchmarkResults:
+    """
+    Named benchmark measurements, each with a unit and whether higher is better.
+    """
+
+    def __init__(self):
+        self.results: dict[str, dict] = {}
+
+    def add(self, name, value, unit, higher_is_better=True):
+        self.results[name] = {
+            "value": value,
+            "unit": unit,
+            "higher_is_better": higher_is_better,
+        }
+
+    def compare(self, baseline, tolerance=DEFAULT_TOLERANCE):
+        """
+        Compare against baseline results, returning the comparison for each
+        result that is also in the baseline.
+        """
+
+        comparison = {}
+        for name, result in self.results.items():
+            if name not in baseline or not baseline[name]["value"]:
+                continue
+
+            baseline_value = baseline[name]["value"]
+            change = (result["value"] - baseline_value) / baseline_value
+            if result["higher_is_better"]:
+                regression = change < -tolerance
+            else:
+                regression = change > tolerance
+
+            comparison[name] = {
+                "baseline": baseline_value,
+                "value": result["value"],
+                "change": change,
+                "regression": regression,
+            }
+        return comparison
+
+    def get_regressions(self, baseline, tolerance=DEFAULT_TOLERANCE):
+        return sorted(
+            name
+            for name, comparison in self.compare(baseline, tolerance).items()
+            if comparison["regression"]
+        )
+
+    def format_table(self, baseline=None, tolerance=DEFAULT_TOLERANCE):
+        comparison = self.compare(baseline, tolerance) if baseline else {}
+        lines = []
+        for name, result in self.results.items():
+            line = "{0:<50} {1:>12.3f} {2:<8}".format(
+                name,
+                result["value"],
+                result["unit"],
+            )
+            if name in comparison:
+                line = "{0} {1:>+8.1%}{2}".format(
+                    line,
+                    comparison[name]["change"],
+                    " REGRESSION" if comparison[name]["regression"] else "",
+                )
+            lines.append(line)
+        return "\n".join(lines)
+
+    def to_dict(self, baseline=None, tolerance=DEFAULT_TOLERANCE):
+        data = {"results": self.results}
+        if baseline:
+            data["comparison"] = self.compare(baseline, tolerance)
+        return data
+
+
+def load_baseline(filename):
+    if not filename or not path.exists(filename):
+        return None
+
+    with open(filename, encoding="utf-8") as f:
+        return json.load(f)["results"]
+
+
+def save_results(filename, results, baseline=None, tolerance=DEFAULT_TOLERANCE):
+    with open(filename, "w", encoding="utf-8") as f:
+        json.dump(results.to_dict(baseline, tolerance), f, indent=4, sort_keys=True)
+        f.write("\n")
@@ -0,0 +1,148 @@
+import hashlib
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from os import path
+from threading import Thread
+from unittest import TestCase, skipIf, skipUnless
+from unittest.mock import patch
+
+from pyinfra.api import OperationError
+
+from pyinfra_windows.operations.util import files as files_util
+
+CONTENT = b"pyinfra-windows" * 1024
+
+
+class TestFetchToLocalCache(TestCase):
+    def setUp(self):
+        self.serve_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = tempfile.TemporaryDirectory()
+        with open(path.join(self.serve_dir.name, "artifact.bin"), "wb") as f:
+            f.write(CONTENT)
+
+        self.requests = []
+        serve_dir, requests = self.serve_dir.name, self.requests
+
+        class Handler(SimpleHTTPRequestHandler):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, directory=serve_dir, **kwargs)
+
+            def do_GET(self):
+                requests.append(self.path)
+                super().do_GET()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{0}/artifact.bin".format(self.server.server_port)
+
+        files_util._local_fetches.clear()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.serve_dir.cleanup()
+        self.cache_dir.cleanup()
+
+    def test_fetch_once(self):
+        hashes = {"SHA256": hashlib.sha256(CONTENT).hexdigest().upper()}
+
+        filename = files_util.fetch_to_local_cache(
+            self.url, hashes, cache_dir=self.cache_dir.name
+        )
+        with open(filename, "rb") as f:
+            assert f.read() == CONTENT
+
+        # Verified files are reused, even after the in-process record is gone
+        files_util._local_fetches.clear()
+        assert (
+            files_util.fetch_to_local_cache(
+                self.url, hashes, cache_dir=self.cache_dir.name
+            )
+            == filename
+        )
+        assert self.requests == ["/artifact.bin"]
+
+    def test_fetch_changed_cache_file(self):
+        hashes = {"SHA256": hashlib.sha256(CONTENT).hexdigest().upper()}
+        filename = files_util.fetch_to_local_cache(
+            self.url, hashes, cache_dir=self.cache_dir.name
+        )
+
+        # Cached files from a previous run are checked again before being reused
+        files_util._local_fetches.clear()
+        with open(filename, "wb") as f:
+            f.write(b"tampered")
+        files_util.fetch_to_local_cache(self.url, hashes, cache_dir=self.cache_dir.name)
+
+        with open(filename, "rb") as f:
+            assert f.read() == CONTENT
+        assert self.requests == ["/artifact.bin", "/artifact.bin"]
+
+    @skipIf(os.name == "nt", "POSIX permissions")
+    def test_default_cache_dir_is_private(self):
+        with patch.dict(os.environ, {"XDG_CACHE_HOME": self.cache_dir.name}):
+            cache_dir = files_util.get_local_cache_dir()
+
+        assert cache_dir.startswith(self.cache_dir.name)
+        assert stat.S_IMODE(os.stat(cache_dir).st_mode) == 0o700
+
+    def test_fetch_checksum_mismatch(self):
+        with self.assertRaises(OperationError) as context:
+            files_util.fetch_to_local_cache(
+                self.url, {"MD5": "not-a-match"}, cache_dir=self.cache_dir.name
+            )
+        assert context.exception.args[0] == "MD5 did not match!"
+        assert files_util._local_fetches == {}
+
+
+@skipUnless(shutil.which("pwsh"), "needs PowerShell to run the generated scripts")
+class TestStreamEdit(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.filename = path.join(self.temp_dir.name, "app.ini")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _edit(self, content):
+        with open(self.filename, "wb") as f:
+            f.write(content)
+
+        script = path.join(self.temp_dir.name, "edit.ps1")
+        with open(script, "w", encoding="utf-8-sig") as f:
+            f.write(
+                files_util.make_line_command(
+                    self.filename, "^Port=.*$", "Port=8080", replace="Port=8080"
+                ),
+            )
+        subprocess.run(
+            ["pwsh", "-NoProfile", "-NonInteractive", "-File", script],
+            check=True,
+            capture_output=True,
+        )
+
+        with open(self.filename, "rb") as f:
+            return f.read()
+
+    def test_utf8_without_bom(self):
+        content = "Name=Zoë\nPort=80\n".encode("utf-8")
+        assert self._edit(content) == "Name=Zoë\nPort=8080\n".encode("utf-8")
+
+    def test_utf8_with_bom(self):
+        content = "Name=Zoë\r\nPort=80\r\n".encode("utf-8-sig")
+        assert self._edit(content) == "Name=Zoë\r\nPort=8080\r\n".encode("utf-8-sig")
+
+    def test_utf16_with_bom(self):
+        content = "Name=Zoë\r\nPort=80\r\n".encode("utf-16")
+        assert self._edit(content) == "Name=Zoë\r\nPort=8080\r\n".encode("utf-16")
+
+    def test_ansi(self):
+        content = "Name=Zoë\r\nPort=80\r\n".encode("cp1252")
+        assert self._edit(content) == "Name=Zoë\r\nPort=8080\r\n".encode("cp1252")
@@ -0,0 +1,118 @@
+from unittest import TestCase
+
+from pyinfra_windows.facts.util.format_list import (
+    PROPERTY_SAMPLE_SIZE,
+    RecordBuilder,
+    RecordSchema,
+    get_record_builder,
+    iter_format_list_records,
+)
+
+
+class TestIterFormatListRecords(TestCase):
+    def test_records_are_yielded_lazily(self):
+        read_lines = []
+
+        def output():
+            for line in ("Name : one", "Size : 1", "", "Name : two", "Size : 2", ""):
+                read_lines.append(line)
+                yield line
+
+        records = iter_format_list_records(output())
+
+        assert next(records) == {"Name": "one", "Size": "1"}
+        assert len(read_lines) == 3
+        assert list(records) == [{"Name": "two", "Size": "2"}]
+
+    def test_last_record_without_blank_line(self):
+        records = list(iter_format_list_records(["Name : one", "Value : a", "  b"]))
+
+        assert records == [{"Name": "one", "Value": "ab"}]
+
+    def test_wrapped_values(self):
+        records = list(
+            iter_format_list_records(
+                [
+                    "",
+                    "Name        : AppHost",
+                    "Description : Runs host.exe for users. Note : this service is",
+                    "              started by svchost.exe",
+                    "StartName   :",
+                    "",
+                    "Name        : W32Time",
+                    "",
+                ],
+            ),
+        )
+
+        assert records == [
+            {
+                "Name": "AppHost",
+                "Description": (
+                    "Runs host.exe for users. Note : this service isstarted by svchost.exe"
+                ),
+                "StartName": "",
+            },
+            {"Name": "W32Time"},
+        ]
+
+
+class TestRecordBuilder(TestCase):
+    def test_records_share_schema_and_values(self):
+        builder = RecordBuilder()
+        first = builder.build({"Name": "one", "Status": "Running"})
+        second = builder.build({"Name": "two", "Status": "Running"})
+
+        assert first.schema is second.schema
+        assert first["Status"] is second["Status"]
+
+    def test_unhashable_values(self):
+        record = RecordBuilder().build({"Name": "one", "IPAddress": ["10.0.0.1"]})
+
+        assert record["IPAddress"] == ["10.0.0.1"]
+
+    def test_dict_style_access(self):
+        record = RecordBuilder().build({"Name": "one", "Status": "Running"})
+
+        assert record == {"Name": "one", "Status": "Running"}
+        assert record.get("Missing") is None
+        assert "Status" in record
+        assert list(record.items()) == [("Name", "one"), ("Status", "Running")]
+        assert record.to_json() == {"Name": "one", "Status": "Running"}
+        with self.assertRaises(KeyError):
+            record["Missing"]
+
+    def test_unique_values_stored_by_record(self):
+        builder = RecordBuilder()
+        records = [
+            builder.build(
+                {
+                    "Name": "svchost",
+                    "StartTime": "1/1/2020 {0}".format(i),
+                    "Id": str(i),
+                },
+            )
+            for i in range(PROPERTY_SAMPLE_SIZE * 2)
+        ]
+
+        assert len(builder.values) <= PROPERTY_SAMPLE_SIZE
+        assert records[-1].strings == records[-1]["StartTime"]
+        assert records[-1]["Name"] is records[0]["Name"]
+        assert [record["Id"] for record in records] == [
+            str(i) for i in range(PROPERTY_SAMPLE_SIZE * 2)
+        ]
+
+    def test_separator_and_repeated_values(self):
+        builder = RecordBuilder()
+        builder.schemas[("A", "B", "C")] = schema = RecordSchema(
+            ("A", "B", "C"),
+            builder.values,
+        )
+        schema.local = [True, True, True]
+        record = builder.build({"A": "x\x1fy", "B": "007", "C": "007"})
+
+        assert record == {"A": "x\x1fy", "B": "007", "C": "007"}
+        assert record.strings == "007"
+
+    def test_shared_record_builder(self):
+        assert get_record_builder() is get_record_builder()
@@ -1,10 +1,37 @@
-from unittest import TestCase
+import base64
+import gzip
+import hashlib
+import json
+import re
+import shutil
+import subprocess
+import tempfile
+from collections import Counter
+from io import BytesIO
+from os import path
+from time import time
+from unittest import TestCase, skipUnless
 from unittest.mock import MagicMock, patch
 
 from pyinfra.api import Config, State
 from pyinfra.api.connect import connect_all
+from pyinfra.api.facts import get_facts
+from pyinfra.connectors.util import CommandOutput, OutputLine
+from pyinfra.context import ctx_host, ctx_state
+from winrm.exceptions import WSManFaultError
+
+from pyinfra_windows.connectors.pyinfrawinrmsession import (
+    MAX_COMMAND_LENGTH,
+    PyinfraWinrmSession,
+    _decompress_output,
+)
+from pyinfra_windows.connectors.stats import LatencyHistogram, WinRMStats
+from pyinfra_windows.connectors.util import loading_fact
+from pyinfra_windows.facts.server import Hostname, Services
+from pyinfra_windows.operations import registry, server
 
 from .util import make_inventory
+from .winrm_server import CommandResult, FakeWinRMServer
 
 
 class TestWinrmConnector(TestCase):
@@ -48,13 +75,38 @@ class TestWinrmConnector(TestCase):
 
         assert len(state.active_hosts) == 2
 
+    @patch("pyinfra_windows.connectors.winrm.WinRMConnector._put_file")
+    @patch("pyinfra_windows.connectors.winrm.WinRMConnector.run_shell_command")
+    def test_put_file(self, fake_run_shell_command, fake_put_file):
+        fake_put_file.return_value = True
+        inventory = make_inventory(hosts=("@winrm/somehost",))
+        State(inventory, Config())
+        host = inventory.get_host("@winrm/somehost")
+        host.connect()
+
+        fake_run_shell_command.return_value = (True, CommandOutput([]))
+        with patch.object(host, "get_fact", return_value="C:\\Temp"):
+            assert host.connector.put_file(BytesIO(b"hi"), "C:\\hi.txt") is True
+        assert fake_run_shell_command.call_count == 1
+
+        fake_run_shell_command.return_value = (
+            False,
+            CommandOutput([OutputLine("stderr", "Access is denied")]),
+        )
+        with patch.object(host, "get_fact", return_value="C:\\Temp"):
+            assert host.connector.put_file(BytesIO(b"hi"), "C:\\hi.txt") is False
+
     @patch("pyinfra_windows.connectors.winrm.PyinfraWinrmSession")
     def test_run_shell_command(self, fake_winrm_session):
         p = patch("pyinfra_windows.connectors.winrm.WinRMConnector.session")
         fake_session = p.start()
 
-        fake_resp = MagicMock()
-        fake_resp.status_code = 1
+        fake_resp = MagicMock(
+            status_code=1,
+            std_out=b"hi",
+            std_err=b"",
+            remote_seconds=None,
+        )
         fake_session.run_ps.return_value = fake_resp
         inventory = make_inventory(hosts=("@winrm/somehost",))
         State(inventory, Config())
@@ -76,4 +128,618 @@ class TestWinrmConnector(TestCase):
             print_output=True,
         )
         assert len(combined_out) == 2
-        fake_session.run_ps.assert_called_with("echo hi", env={})
+        fake_session.run_ps.assert_called_with(
+            "echo hi",
+            env={},
+            remote_timing=False,
+            compress_output=False,
+            conditional_output=False,
+            known_output_hash=None,
+        )
+
+
+class TestPyinfraWinrmSession(TestCase):
+    def _decode_command(self, command):
+        prefix = "powershell -encodedcommand "
+        assert command.startswith(prefix)
+        return base64.b64decode(command[len(prefix) :]).decode("utf_16_le")
+
+    @patch("pyinfra_windows.connectors.pyinfrawinrmsession.PyinfraWinrmSession.run_cmd")
+    def test_run_ps_short_script(self, fake_run_cmd):
+        fake_run_cmd.return_value = MagicMock(std_err=b"")
+        session = PyinfraWinrmSession("somehost", auth=("user", "pass"))
+        session.run_ps("echo hi")
+
+        command = fake_run_cmd.call_args[0][0]
+        assert self._decode_command(command) == "echo hi"
+
+    @patch("pyinfra_windows.connectors.pyinfrawinrmsession.PyinfraWinrmSession.run_cmd")
+    def test_run_ps_long_script_is_compressed(self, fake_run_cmd):
+        fake_run_cmd.return_value = MagicMock(std_err=b"")
+        session = PyinfraWinrmSession("somehost", auth=("user", "pass"))
+        script = "\n".join("Write-Output {0}".format(i) for i in range(400))
+        session.run_ps(script)
+
+        command = fake_run_cmd.call_args[0][0]
+        assert len(command) <= MAX_COMMAND_LENGTH
+
+        bootstrap = self._decode_command(command)
+        compressed = re.search(r"FromBase64String\('([^']+)'\)", bootstrap).group(1)
+        assert gzip.decompress(base64.b64decode(compressed)).decode("utf-8") == script
+
+    def test_run_ps_too_long_script_is_sent_on_stdin(self):
+        # Random names don't compress, 400 of them are over the limit even gzipped
+        script = "\n".join(
+            "Write-Output {0}".format(hashlib.sha256(str(i).encode()).hexdigest())
+            for i in range(400)
+        )
+        session = PyinfraWinrmSession("somehost", auth=("user", "pass"))
+        with patch.object(session, "protocol") as fake_protocol:
+            fake_protocol.get_command_output.return_value = (b"", b"", 0)
+            session.run_ps(script)
+
+        command = fake_protocol.run_command.call_args[0][1]
+        assert len(command) <= MAX_COMMAND_LENGTH
+        assert "-join $input" in self._decode_command(command)
+
+        sent = [call[0][2] for call in fake_protocol.send_command_input.call_args_list]
+        assert sent[-1] == ""
+        assert gzip.decompress(base64.b64decode(b"".join(sent[:-1]))) == (
+            script.encode("utf-8")
+        )
+
+    @patch("pyinfra_windows.connectors.pyinfrawinrmsession.PyinfraWinrmSession.run_cmd")
+    def test_run_ps_remote_timing(self, fake_run_cmd):
+        fake_run_cmd.return_value = MagicMock(
+            std_out=b"hi\r\n__PYINFRA_REMOTE_TICKS__ 15000000\r\n",
+            std_err=b"",
+        )
+        session = PyinfraWinrmSession("somehost", auth=("user", "pass"))
+        response = session.run_ps("echo hi", remote_timing=True)
+
+        script = self._decode_command(fake_run_cmd.call_args[0][0])
+        assert "[Diagnostics.Stopwatch]::StartNew()" in script
+        assert "try {\necho hi\n$global:__pyinfra_ok = $?;" in script
+        assert script.endswith("} else { 1 }) }")
+
+        assert response.std_out == b"hi\r\n"
+        assert response.remote_seconds == 1.5
+
+    @patch("pyinfra_windows.connectors.pyinfrawinrmsession.PyinfraWinrmSession.run_cmd")
+    def test_run_ps_compress_output(self, fake_run_cmd):
+        compressed = base64.b64encode(gzip.compress(b"line 1\r\nline 2\r\n"))
+        fake_run_cmd.return_value = MagicMock(
+            std_out=b"__PYINFRA_GZIP__ " + compressed + b"\r\n",
+            std_err=b"",
+        )
+        session = PyinfraWinrmSession("somehost", auth=("user", "pass"))
+        response = session.run_ps("Get-Lines", compress_output=True)
+
+        script = self._decode_command(fake_run_cmd.call_args[0][0])
+        assert script.startswith("$__pyinfra_output = & {\nGet-Lines\n$global:")
+        assert "\n} | Out-String\n" in script
+        assert script.endswith("} else { 1 }) }")
+        assert response.std_out == b"line 1\r\nline 2\r\n"
+
+    @patch("pyinfra_windows.connectors.pyinfrawinrmsession.PyinfraWinrmSession.run_cmd")
+    def test_run_ps_conditional_output(self, fake_run_cmd):
+        fake_run_cmd.return_value = MagicMock(
+            std_out=b"__PYINFRA_OUTPUT_HASH__ ABC\r\nline 1\r\n",
+            std_err=b"",
+        )
+        session = PyinfraWinrmSession("somehost", auth=("user", "pass"))
+        response = session.run_ps("Get-Lines", conditional_output=True)
+
+        assert response.std_out == b"line 1\r\n"
+        assert response.output_hash == "ABC"
+        assert not response.output_unchanged
+
+        fake_run_cmd.return_value = MagicMock(
+            std_out=b"__PYINFRA_OUTPUT_UNCHANGED__ ABC\r\n",
+            std_err=b"",
+        )
+        response = session.run_ps(
+            "Get-Lines",
+            conditional_output=True,
+            known_output_hash="ABC",
+        )
+
+        script = self._decode_command(fake_run_cmd.call_args[0][0])
+        assert "-eq 'ABC'" in script
+        assert response.std_out == b""
+        assert response.output_unchanged
+
+    def _run_with_pwsh(self, script, **kwargs):
+        """
+        Run the command ``run_ps`` would send with a local PowerShell, returning its
+        exit code and output.
+        """
+
+        session = PyinfraWinrmSession("somehost", auth=("user", "pass"))
+        with patch.object(session, "run_cmd") as fake_run_cmd:
+            fake_run_cmd.return_value = MagicMock(std_err=b"")
+            session.run_ps(script, **kwargs)
+
+        encoded = fake_run_cmd.call_args[0][0].split(" ")[-1]
+        result = subprocess.run(
+            ["pwsh", "-NoProfile", "-NonInteractive", "-EncodedCommand", encoded],
+            capture_output=True,
+        )
+        return result.returncode, result.stdout
+
+    @skipUnless(shutil.which("pwsh"), "needs PowerShell to run the wrapped scripts")
+    def test_run_ps_wrappers_keep_exit_status(self):
+        for kwargs in (
+            {"remote_timing": True},
+            {"compress_output": True},
+            {"conditional_output": True},
+            {
+                "remote_timing": True,
+                "compress_output": True,
+                "conditional_output": True,
+            },
+        ):
+            assert self._run_with_pwsh("Write-Output hi", **kwargs)[0] == 0
+            assert self._run_with_pwsh("Get-Item C:\\missing", **kwargs)[0] == 1
+            assert self._run_with_pwsh("exit 3", **kwargs)[0] == 3
+            # The exit code of a failed program is kept
+            assert self._run_with_pwsh("pwsh -c 'exit 4'", **kwargs)[0] == 4
+
+    @skipUnless(shutil.which("pwsh"), "needs PowerShell to run the wrapped scripts")
+    def test_run_ps_compress_output_is_formatted(self):
+        _, output = self._run_with_pwsh(
+            "'text'; [pscustomobject]@{Name = 'Spooler'}",
+            compress_output=True,
+        )
+
+        # Objects come back formatted by Out-String, as the console would show them
+        lines = _decompress_output(output).decode("utf-8").splitlines()
+        assert lines[0] == "text"
+        assert [line.strip() for line in lines if line.strip()][1:] == [
+            "Name",
+            "----",
+            "Spooler",
+        ]
+
+    def test_run_cmd_times_phases(self):
+        session = PyinfraWinrmSession("somehost", auth=("user", "pass"))
+        with patch.object(session, "protocol") as fake_protocol:
+            fake_protocol.get_command_output.return_value = (b"hi", b"", 0)
+            session.run_cmd("echo hi")
+
+        assert [phase for phase, _ in session.timings] == [
+            "open_shell",
+            "run_command",
+            "receive",
+            "cleanup_command",
+            "close_shell",
+        ]
+
+
+class TestWinRMStats(TestCase):
+    def test_session_counts_requests(self):
+        session = PyinfraWinrmSession("somehost", auth=("user", "pass"))
+        with patch.object(
+            session.protocol.transport, "send_message", return_value=b"<response/>"
+        ):
+            session.protocol.send_message("<request/>")
+
+        assert session.counters == Counter(
+            soap_requests=1, bytes_sent=10, bytes_received=11
+        )
+
+    def test_record_by_operation_and_fact(self):
+        stats = WinRMStats()
+        host = MagicMock(current_op_hash=None, executing_op_hash="an-op-hash")
+        host.name = "somehost"
+        host.state.get_op_meta.return_value.names = {"Install packages"}
+
+        stats.record(host, Counter(commands=1, soap_requests=5))
+
+        with loading_fact("server.Hostname"):
+            stats.record(host, Counter(commands=1, soap_requests=4))
+
+        data = stats.to_dict()["somehost"]
+        assert data["total"]["commands"] == 2
+        assert data["total"]["soap_requests"] == 9
+        assert data["operations"]["Install packages"]["soap_requests"] == 5
+        assert data["facts"]["server.Hostname"]["soap_requests"] == 4
+
+    def test_write_report(self):
+        stats = WinRMStats()
+        host = MagicMock(current_op_hash=None, executing_op_hash=None)
+        host.name = "somehost"
+        stats.record(host, Counter(commands=1, upload_bytes=2048, upload_seconds=2))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = path.join(temp_dir, "report.json")
+            stats.report_filename = filename
+            with patch("pyinfra_windows.connectors.stats.click.echo") as fake_echo:
+                stats.write_report()
+
+            with open(filename, encoding="utf-8") as f:
+                report = json.load(f)
+
+        assert report["somehost"]["operations"]["Other"]["upload_bytes"] == 2048
+        table = fake_echo.call_args[0][0]
+        assert "somehost" in table
+        assert "1.0" in table.splitlines()[1]
+
+    def test_latency_histogram_quantiles(self):
+        histogram = LatencyHistogram()
+        for i in range(100):
+            histogram.observe((i + 1) / 1000)
+
+        assert histogram.count == 100
+        assert histogram.quantile(0.5) == 0.05
+        assert round(histogram.quantile(0.99), 6) == 0.099
+        assert histogram.to_dict()["p95"] == histogram.quantile(0.95)
+        assert LatencyHistogram().quantile(0.5) == 0.0
+
+    def test_prometheus_export(self):
+        stats = WinRMStats()
+        host = MagicMock(current_op_hash=None, executing_op_hash=None)
+        host.name = "somehost"
+        stats.record(host, Counter(commands=1))
+        stats.record_timings(host, [("open_shell", 0.02), ("open_shell", 2)])
+
+        text = stats.to_prometheus()
+        assert 'pyinfra_winrm_commands_total{host="somehost"} 1' in text
+        assert (
+            'pyinfra_winrm_phase_seconds_bucket{host="somehost",phase="open_shell",'
+            'le="0.025"} 1'
+        ) in text
+        assert (
+            'pyinfra_winrm_phase_seconds_bucket{host="somehost",phase="open_shell",'
+            'le="+Inf"} 2'
+        ) in text
+        assert (
+            'pyinfra_winrm_phase_seconds_count{host="somehost",phase="open_shell"} 2'
+        ) in text
+        assert stats.to_dict()["somehost"]["latency"]["open_shell"]["count"] == 2
+
+
+class TestWinrmConnectorFakeServer(TestCase):
+    def setUp(self):
+        self.server = FakeWinRMServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _connect(self):
+        inventory = make_inventory(
+            hosts=("@winrm/somehost",),
+            override_data={
+                "winrm_hostname": self.server.endpoint,
+                "ssh_user": "user",
+                "ssh_password": "pass",
+            },
+        )
+        State(inventory, Config())
+        host = inventory.get_host("@winrm/somehost")
+        host.connect()
+        return host
+
+    def test_run_shell_command(self):
+        self.server.add_response("^hostname$", CommandResult("win01"))
+        host = self._connect()
+
+        status, output = host.run_shell_command("hostname")
+
+        assert status is True
+        assert output.stdout_lines == ["win01"]
+        assert self.server.scripts == ["hostname"]
+        assert self.server.requests == Counter(
+            Create=1, Command=1, Receive=1, Signal=1, Delete=1
+        )
+
+    def test_run_shell_command_output_in_chunks(self):
+        lines = ["line {0}".format(i) for i in range(100)]
+        self.server.receive_chunk_size = 100
+        self.server.add_response("Get-Lines", CommandResult("\r\n".join(lines)))
+        host = self._connect()
+
+        status, output = host.run_shell_command("Get-Lines", _env={"A": "b"})
+
+        assert status is True
+        assert output.stdout_lines == lines
+        assert self.server.requests["Receive"] > 1
+
+    def test_run_shell_command_failure_exit_code(self):
+        self.server.add_response("Fail-Me", CommandResult(stderr="nope", exit_code=3))
+        host = self._connect()
+
+        status, output = host.run_shell_command("Fail-Me")
+
+        assert status is False
+        assert output.stderr_lines == ["nope"]
+
+    def test_stats_by_fact(self):
+        self.server.add_response("^hostname$", CommandResult("win01"))
+        host = self._connect()
+
+        with patch(
+            "pyinfra_windows.connectors.winrm.winrm_stats", WinRMStats()
+        ) as stats:
+            assert host.get_fact(Hostname) == "win01"
+            host.run_shell_command("hostname")
+
+        data = stats.to_dict()["@winrm/somehost"]
+        assert data["facts"][Hostname.name]["commands"] == 1
+        assert data["operations"]["Other"]["commands"] == 1
+
+    def test_stats_by_fact_with_get_facts(self):
+        self.server.add_response("^hostname$", CommandResult("win01"))
+        host = self._connect()
+
+        host.state.activate_host(host)
+
+        # The get_facts route bypasses host.get_fact, so the fact isn't known
+        with patch(
+            "pyinfra_windows.connectors.winrm.winrm_stats", WinRMStats()
+        ) as stats:
+            assert get_facts(host.state, Hostname) == {host: "win01"}
+
+        data = stats.to_dict()["@winrm/somehost"]
+        assert data["facts"] == {}
+        assert data["operations"]["Other"]["commands"] == 1
+
+    def test_injected_failure(self):
+        self.server.failures["Create"] = 1
+        self.server.add_response("hostname", CommandResult("win01\r\n"))
+        host = self._connect()
+
+        with self.assertRaises(WSManFaultError):
+            host.run_shell_command("hostname")
+
+        status, _ = host.run_shell_command("hostname")
+        assert status is True
+
+    def test_compress_output_for_facts(self):
+        output = '{"Name":"Spooler","State":"Running"}\r\n'
+
+        def get_services(script):
+            if "__PYINFRA_GZIP__" not in script:
+                return CommandResult(output)
+            # Do what the wrapper would do on the target
+            compressed = base64.b64encode(gzip.compress(output.encode("utf-8")))
+            return CommandResult(b"__PYINFRA_GZIP__ " + compressed + b"\r\n")
+
+        self.server.add_response("Win32_Service", get_services)
+        self.server.add_response("hostname", CommandResult("win01"))
+        host = self._connect()
+        host.data.winrm_compress_output = ["server.Services"]
+
+        assert host.get_fact(Services) == {
+            "Name": {"Spooler": {"State": "Running"}},
+        }
+        assert "__PYINFRA_GZIP__" in self.server.scripts[-1]
+
+        assert host.get_fact(Hostname) == "win01"
+        assert self.server.scripts[-1] == "hostname"
+
+    def _add_conditional_services_response(self, output):
+        def get_services(script):
+            # Do what the wrapper would do on the target
+            output_hash = hashlib.sha256(output.encode("utf-8")).hexdigest().upper()
+            if "-eq '{0}'".format(output_hash) in script:
+                return CommandResult(
+                    "__PYINFRA_OUTPUT_UNCHANGED__ {0}\r\n".format(output_hash),
+                )
+            return CommandResult(
+                "__PYINFRA_OUTPUT_HASH__ {0}\r\n{1}".format(output_hash, output),
+            )
+
+        self.server.add_response("Win32_Service", get_services)
+
+    def test_conditional_facts(self):
+        self._add_conditional_services_response(
+            '{"Name":"Spooler","State":"Running"}\r\n',
+        )
+        host = self._connect()
+        host.data.winrm_conditional_facts = ["server.Services"]
+
+        expected = {"Name": {"Spooler": {"State": "Running"}}}
+        assert host.get_fact(Services) == expected
+        assert host.get_fact(Services) == expected
+        assert host.connector.session.counters["unchanged_outputs"] == 1
+
+    def test_conditional_facts_failure_not_cached(self):
+        self.server.add_response(
+            "Win32_Service",
+            CommandResult(
+                '__PYINFRA_OUTPUT_HASH__ ABC\r\n{"Name":"Spooler"',
+                exit_code=1,
+            ),
+        )
+        host = self._connect()
+        host.data.winrm_conditional_facts = True
+
+        host.get_fact(Services, _ignore_errors=True)
+        assert "Win32_Service" in self.server.scripts[-1]
+        assert "__PYINFRA_OUTPUT_HASH__" in self.server.scripts[-1]
+        assert host.connector.output_cache == {}
+
+    def test_conditional_facts_cache_dir(self):
+        self._add_conditional_services_response('{"Name":"Spooler","State":"Running"}')
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for _ in range(2):
+                host = self._connect()
+                host.data.winrm_conditional_facts = True
+                host.data.winrm_output_cache_dir = cache_dir
+                assert host.get_fact(Services) == {
+                    "Name": {"Spooler": {"State": "Running"}},
+                }
+
+        assert host.connector.session.counters["unchanged_outputs"] == 1
+
+    def test_run_shell_command_too_long(self):
+        script = "\n".join(
+            "Write-Output {0}".format(hashlib.sha256(str(i).encode()).hexdigest())
+            for i in range(400)
+        )
+        self.server.add_response("^Write-Output", CommandResult("done"))
+        host = self._connect()
+
+        status, output = host.run_shell_command(script)
+        assert status is True
+        assert output.stdout_lines == ["done"]
+        assert self.server.scripts[-1] == script
+
+    def test_registry_values_large_batch(self):
+        values = {
+            "HKLM:\\SOFTWARE\\Baseline\\{0}".format(key): {
+                "Setting{0}".format(hashlib.sha1(str(i).encode()).hexdigest()): i
+                for i in range(key * 10, key * 10 + 10)
+            }
+            for key in range(25)
+        }
+        # Every value exists with another value, so all of them are set again
+        self.server.add_response(
+            "GetValueKind",
+            CommandResult(
+                "\r\n".join(
+                    json.dumps(
+                        {
+                            "Path": key,
+                            "Exists": True,
+                            "Values": {
+                                name: {"Type": "DWord", "Value": 0}
+                                for name in key_values
+                            },
+                        },
+                    )
+                    for key, key_values in values.items()
+                ),
+            ),
+        )
+        self.server.add_response("New-ItemProperty", CommandResult())
+        host = self._connect()
+
+        with ctx_state.use(host.state), ctx_host.use(host):
+            commands = list(registry.values._inner(values))
+        fact_script = self.server.scripts[-1]
+        assert "GetValueKind" in fact_script
+
+        assert len(commands) == 1
+        status, _ = host.run_shell_command(commands[0])
+        assert status is True
+        assert self.server.scripts[-1] == commands[0]
+
+        # Both scripts were too long for the command line, even gzipped
+        for script in (fact_script, commands[0]):
+            _, script_input = host.connector.session._make_ps_command(script)
+            assert script_input is not None
+
+    def _wait_for_reboot(self, host, **kwargs):
+        """
+        Run the reboot operation on a fake clock, returning what waiting for the
+        reconnection returned and the intervals waited.
+        """
+
+        clock = [0]
+        sleeps = []
+
+        def fake_sleep(seconds):
+            sleeps.append(seconds)
+            clock[0] += seconds
+
+        with (
+            ctx_state.use(host.state),
+            ctx_host.use(host),
+            patch("pyinfra_windows.operations.server.sleep", fake_sleep),
+            patch("pyinfra_windows.operations.server.time", lambda: clock[0]),
+        ):
+            capture, restart, wait = server.reboot._inner(**kwargs)
+            capture.function(host.state, host)
+            assert host.run_shell_command(restart)[0] is True
+            reconnected = wait.function(host.state, host)
+
+        return reconnected, sleeps
+
+    def test_reboot_reconnects_once_last_reboot_changes(self):
+        def fail_next_shell():
+            self.server.failures["Create"] = 1
+            return CommandResult("20240101000000.000000+000")
+
+        # Before the reboot, still up, then failing to connect and to run the fact
+        last_reboots = iter(
+            [lambda: CommandResult("20240101000000.000000+000")] * 4
+            + [
+                fail_next_shell,
+                lambda: CommandResult(stderr="shutting down", exit_code=1),
+                lambda: CommandResult("20240102000000.000000+000"),
+            ],
+        )
+        self.server.add_response(
+            "LastBootUptime",
+            lambda script: next(last_reboots)(),
+        )
+        self.server.add_response("^Restart-Computer -Force$", CommandResult())
+        host = self._connect()
+
+        reconnected, sleeps = self._wait_for_reboot(host, interval=1, max_interval=3)
+
+        assert reconnected is True
+        # Doubled after each attempt, up to the maximum interval
+        assert sleeps == [1, 2, 3, 3, 3, 3]
+
+    def test_reboot_gives_up_at_deadline(self):
+        self.server.add_response(
+            "LastBootUptime",
+            CommandResult("20240101000000.000000+000"),
+        )
+        self.server.add_response("^Restart-Computer -Force$", CommandResult())
+        host = self._connect()
+
+        reconnected, sleeps = self._wait_for_reboot(
+            host,
+            interval=1,
+            max_interval=4,
+            reboot_timeout=10,
+        )
+
+        assert reconnected is False
+        assert sleeps == [1, 2, 4]
+
+    def test_injected_latency(self):
+        self.server.latency = {"Create": 0.2}
+        self.server.add_response("hostname", CommandResult("win01"))
+        host = self._connect()
+
+        start = time()
+        host.run_shell_command("hostname")
+        assert time() - start >= 0.2
+
+    def test_put_file_in_chunks(self):
+        self.server.add_response("GetTempPath", CommandResult("C:\\Temp\\\r\n"))
+        self.server.add_response("FromBase64String", CommandResult())
+        self.server.add_response("^Move-Item", CommandResult())
+        host = self._connect()
+
+        data = bytes(range(256)) * 20
+        assert host.put_file(BytesIO(data), "C:\\data.bin") is True
+        assert (
+            host.connector._put_file(BytesIO(data), "C:\\data.bin", chunk_size=2048)
+            is True
+        )
+
+        # Each upload ran a single PowerShell process, fed on its standard input
+        assert base64.b64decode(self.server.inputs[-3]) == data
+        chunked_lines = self.server.inputs[-1].split(b"\r\n")
+        assert len(chunked_lines) == 4
+        assert b"".join(base64.b64decode(line) for line in chunked_lines) == data
+        assert self.server.requests["Send"] == 2 + 4
+        assert self.server.scripts[-2].startswith("Move-Item -Path C:\\Temp\\")
+
+    def test_put_file_error(self):
+        self.server.add_response("GetTempPath", CommandResult("C:\\Temp\\\r\n"))
+        self.server.add_response(
+            "FromBase64String",
+            CommandResult(stderr="Access is denied", exit_code=1),
+        )
+        host = self._connect()
+
+        assert host.put_file(BytesIO(b"data"), "C:\\data.bin") is False
+        assert not any(script.startswith("Move-Item") for script in self.server.scripts)
@@ -0,0 +1,388 @@
+"""
+A stand-in WS-Man (WinRM) server for tests and benchmarks, implementing enough
+of the Windows shell resource (Create/Command/Receive/Send/Signal/Delete) for
+pywinrm, over plain HTTP with basic auth.
+
+Commands are answered from a table of ``(pattern, result)`` pairs matched
+against the command line, or the decoded script for ``powershell
+-encodedcommand``. Latency, bandwidth limits and failures can be injected.
+
+.. code:: python
+
+    with FakeWinRMServer(responses=[("hostname", CommandResult("win01\\r\\n"))]) as server:
+        session = PyinfraWinrmSession(server.endpoint, auth=("user", "pass"))
+        session.run_ps("hostname")
+"""
+
+from __future__ import annotations
+
+import base64
+import gzip
+import re
+import socket
+import uuid
+import xml.etree.ElementTree as ET
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import sleep
+
+from pyinfra_windows.connectors.pyinfrawinrmsession import STDIN_BOOTSTRAP
+
+NAMESPACES = {
+    "env": "http://www.w3.org/2003/05/soap-envelope",
+    "a": "http://schemas.xmlsoap.org/ws/2004/08/addressing",
+    "w": "http://schemas.dmtf.org/wbem/wsman/1/wsman.xsd",
+    "rsp": "http://schemas.microsoft.com/wbem/wsman/1/windows/shell",
+}
+
+ACTION_PREFIXES = (
+    "http://schemas.xmlsoap.org/ws/2004/09/transfer/",
+    "http://schemas.microsoft.com/wbem/wsman/1/windows/shell/",
+)
+
+COMMAND_DONE = (
+    "http://schemas.microsoft.com/wbem/wsman/1/windows/shell/CommandState/Done"
+)
+COMMAND_RUNNING = (
+    "http://schemas.microsoft.com/wbem/wsman/1/windows/shell/CommandState/Running"
+)
+
+ENVELOPE = (
+    '<s:Envelope xmlns:s="{env}" xmlns:a="{a}" xmlns:w="{w}" xmlns:rsp="{rsp}" '
+    'xmlns:x="http://schemas.xmlsoap.org/ws/2004/09/transfer">'
+    "<s:Header><a:Action>{{action}}</a:Action>"
+    "<a:MessageID>uuid:{{message_id}}</a:MessageID>"
+    "<a:RelatesTo>{{relates_to}}</a:RelatesTo></s:Header>"
+    "<s:Body>{{body}}</s:Body></s:Envelope>"
+).format(**NAMESPACES)
+
+FAULT_BODY = (
+    "<s:Fault><s:Code><s:Value>s:Receiver</s:Value></s:Code>"
+    '<s:Reason><s:Text xml:lang="en-US">{0}</s:Text></s:Reason>'
+    "<s:Detail><f:WSManFault "
+    'xmlns:f="http://schemas.microsoft.com/wbem/wsman/1/wsmanfault" '
+    'Code="{1}"/></s:Detail></s:Fault>'
+)
+
+ENCODED_COMMAND_REGEX = re.compile(r"^powershell -encodedcommand (\S+)$")
+GZIP_BOOTSTRAP_REGEX = re.compile(r"FromBase64String\('([^']+)'\)")
+
+
+class CommandResult:
+    """
+    The output and exit code of a command.
+    """
+
+    def __init__(self, stdout=b"", stderr=b"", exit_code=0):
+        self.stdout = stdout.encode("utf-8") if isinstance(stdout, str) else stdout
+        self.stderr = stderr.encode("utf-8") if isinstance(stderr, str) else stderr
+        self.exit_code = exit_code
+
+
+def decode_script(command_line):
+    """
+    Returns the PowerShell script behind ``powershell -encodedcommand``, undoing
+    the gzip bootstrap used for long scripts, or the command line as-is.
+    """
+
+    match = ENCODED_COMMAND_REGEX.match(command_line)
+    if not match:
+        return command_line
+
+    script = base64.b64decode(match.group(1)).decode("utf_16_le")
+    if script == STDIN_BOOTSTRAP:
+        return script
+    if script.startswith("$s=New-Object IO.Compression.GZipStream"):
+        compressed = GZIP_BOOTSTRAP_REGEX.search(script).group(1)
+        script = gzip.decompress(base64.b64decode(compressed)).decode("utf-8")
+    return script
+
+
+def decode_stdin_script(stdin):
+    """
+    Returns the PowerShell script sent on standard input to the stdin bootstrap.
+    """
+
+    return gzip.decompress(base64.b64decode(stdin)).decode("utf-8")
+
+
+class _Command:
+    def __init__(self, index, result):
+        self.index = index
+        self.result = result
+        self.offset = 0
+
+
+class FakeWinRMServer:
+    """
+    Run a fake WinRM endpoint in a background thread.
+
+    + responses: list of ``(pattern, result)``, where pattern is a regex searched
+      in the script or a callable taking the script; result is a ``CommandResult``
+      or a callable taking the script and returning one
+    + username/password: the basic auth credentials to accept
+    + latency: seconds to wait before each response, or a dict of action -> seconds
+    + bandwidth: bytes per second to limit request and response bodies to
+    + failures: dict of action -> number of upcoming requests to fail with a fault
+    + receive_chunk_size: bytes of output to return per Receive
+
+    The scripts run are kept in ``scripts``, with the standard input sent to each
+    in ``inputs``.
+    """
+
+    def __init__(
+        self,
+        responses=None,
+        username="user",
+        password="pass",
+        latency=0,
+        bandwidth=None,
+        failures=None,
+        receive_chunk_size=64 * 1024,
+    ):
+        self.responses = list(responses or [])
+        self.credentials = "Basic {0}".format(
+            base64.b64encode(
+                "{0}:{1}".format(username, password).encode("utf-8"),
+            ).decode("ascii"),
+        )
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failures = Counter(failures or {})
+        self.receive_chunk_size = receive_chunk_size
+
+        self.requests: Counter = Counter()
+        self.scripts: list[str] = []
+        self.inputs: list[bytes] = []
+        self.shells: dict[str, dict] = {}
+        self.lock = Lock()
+
+        self.httpd = None
+        self.thread = None
+
+    @property
+    def endpoint(self):
+        return "http://127.0.0.1:{0}/wsman".format(self.httpd.server_address[1])
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                # Headers and body are written separately, don't wait for ACKs
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+
+                if self.headers.get("Authorization") != server.credentials:
+                    self.send_response(401)
+                    self.send_header("WWW-Authenticate", 'Basic realm="WSMAN"')
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                status, response = server.handle(body)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/soap+xml;charset=UTF-8")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def add_response(self, pattern, result):
+        self.responses.append((pattern, result))
+
+    def run_script(self, script):
+        for pattern, result in self.responses:
+            if callable(pattern):
+                matched = pattern(script)
+            else:
+                matched = re.search(pattern, script)
+            if matched:
+                return result(script) if callable(result) else result
+
+        return CommandResult(
+            stderr="fake WinRM server has no response for: {0}".format(script),
+            exit_code=1,
+        )
+
+    def handle(self, body):
+        root = ET.fromstring(body)
+        header = root.find("env:Header", NAMESPACES)
+        action = header.find("a:Action", NAMESPACES).text
+        for prefix in ACTION_PREFIXES:
+            action = action.replace(prefix, "")
+        message_id = header.find("a:MessageID", NAMESPACES).text
+        selector = header.find("w:SelectorSet/w:Selector", NAMESPACES)
+        shell_id = selector.text if selector is not None else None
+        request_body = root.find("env:Body", NAMESPACES)
+
+        with self.lock:
+            self.requests[action] += 1
+            fail = self.failures[action] > 0
+            if fail:
+                self.failures[action] -= 1
+
+        if fail:
+            status, response_body = (
+                500,
+                FAULT_BODY.format(
+                    "Injected failure for {0}".format(action),
+                    0x80338000,
+                ),
+            )
+        else:
+            status, response_body = getattr(self, "_handle_{0}".format(action))(
+                shell_id,
+                request_body,
+            )
+
+        response = ENVELOPE.format(
+            action=action,
+            message_id=uuid.uuid4(),
+            relates_to=message_id,
+            body=response_body,
+        ).encode("utf-8")
+
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(action, 0)
+        if self.bandwidth:
+            latency += (len(body) + len(response)) / self.bandwidth
+        if latency:
+            sleep(latency)
+
+        return status, response
+
+    def _handle_Create(self, shell_id, body):
+        shell_id = str(uuid.uuid4()).upper()
+        env = {
+            variable.get("Name"): variable.text
+            for variable in body.iterfind(
+                "rsp:Shell/rsp:Environment/rsp:Variable",
+                NAMESPACES,
+            )
+        }
+        with self.lock:
+            self.shells[shell_id] = {"env": env, "commands": {}}
+        return 200, (
+            "<x:ResourceCreated><a:ReferenceParameters><w:SelectorSet>"
+            '<w:Selector Name="ShellId">{0}</w:Selector>'
+            "</w:SelectorSet></a:ReferenceParameters></x:ResourceCreated>"
+        ).format(shell_id)
+
+    def _handle_Command(self, shell_id, body):
+        command_line = body.find("rsp:CommandLine/rsp:Command", NAMESPACES).text
+        arguments = body.find("rsp:CommandLine/rsp:Arguments", NAMESPACES)
+        if arguments is not None and arguments.text:
+            command_line = "{0} {1}".format(command_line, arguments.text)
+
+        script = decode_script(command_line)
+        command_id = str(uuid.uuid4()).upper()
+        with self.lock:
+            self.scripts.append(script)
+            self.inputs.append(b"")
+            self.shells[shell_id]["commands"][command_id] = _Command(
+                len(self.scripts) - 1,
+                # Scripts sent on standard input are run once they are received
+                None if script == STDIN_BOOTSTRAP else self.run_script(script),
+            )
+        return 200, (
+            "<rsp:CommandResponse><rsp:CommandId>{0}</rsp:CommandId>"
+            "</rsp:CommandResponse>"
+        ).format(command_id)
+
+    def _handle_Send(self, shell_id, body):
+        stream = body.find("rsp:Send/rsp:Stream", NAMESPACES)
+        command = self.shells[shell_id]["commands"][stream.get("CommandId")]
+        with self.lock:
+            self.inputs[command.index] += base64.b64decode(stream.text or "")
+        return 200, "<rsp:SendResponse/>"
+
+    def _handle_Receive(self, shell_id, body):
+        stream = body.find("rsp:Receive/rsp:DesiredStream", NAMESPACES)
+        command_id = stream.get("CommandId")
+        command = self.shells[shell_id]["commands"][command_id]
+        if command.result is None:
+            with self.lock:
+                script = decode_stdin_script(self.inputs[command.index])
+                self.scripts[command.index] = script
+                command.result = self.run_script(script)
+        result = command.result
+
+        # stdout is returned in chunks, then stderr & the exit code at the end
+        start = command.offset
+        command.offset += self.receive_chunk_size
+        stdout = result.stdout[start : command.offset]
+        done = command.offset >= len(result.stdout)
+
+        streams = []
+        if stdout:
+            streams.append(("stdout", stdout))
+        if done and result.stderr:
+            streams.append(("stderr", result.stderr))
+
+        response = ["<rsp:ReceiveResponse>"]
+        for name, data in streams:
+            response.append(
+                '<rsp:Stream Name="{0}" CommandId="{1}">{2}</rsp:Stream>'.format(
+                    name,
+                    command_id,
+                    base64.b64encode(data).decode("ascii"),
+                ),
+            )
+        if done:
+            response.append(
+                '<rsp:CommandState CommandId="{0}" State="{1}">'
+                "<rsp:ExitCode>{2}</rsp:ExitCode></rsp:CommandState>".format(
+                    command_id,
+                    COMMAND_DONE,
+                    result.exit_code,
+                ),
+            )
+        else:
+            response.append(
+                '<rsp:CommandState CommandId="{0}" State="{1}"/>'.format(
+                    command_id,
+                    COMMAND_RUNNING,
+                ),
+            )
+        response.append("</rsp:ReceiveResponse>")
+        return 200, "".join(response)
+
+    def _handle_Signal(self, shell_id, body):
+        signal = body.find("rsp:Signal", NAMESPACES)
+        with self.lock:
+            self.shells[shell_id]["commands"].pop(signal.get("CommandId"), None)
+        return 200, "<rsp:SignalResponse/>"
+
+    def _handle_Delete(self, shell_id, body):
+        with self.lock:
+            self.shells.pop(shell_id, None)
+        return 200, ""